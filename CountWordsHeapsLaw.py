@@ -8,6 +8,12 @@ CountWords
 
     Generates a list with the counts and the words in the 'text' field of the documents in an index
 
+    Heaps' law plot of the indices nov0 .. nov11 (total words, different words of each index)
+
+    With --path the files under the directory are read once, in order, and a (total words, different words)
+    point is taken every --interval words. The vocabulary is a set or, with --hll, a HyperLogLog estimator
+    of its size. The files are tokenized with l2/Analyzer.py (--token and --filter, --filter must be last)
+
 :Authors: bejar
     
 
@@ -28,6 +34,14 @@ from scipy.optimize import curve_fit
 
 import string
 import argparse
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'l2'))
+from TermVectorCache import TermVectorCache
+from Analyzer import Analyzer, tokenizers
+from ReadFiles import generate_files_list
+from CountWordsLocal import read_file
 
 __author__ = 'bejar'
 
@@ -36,7 +50,73 @@ def HeapsLaw(x, k, b):
     return k*(x**b)
 
 
+class HyperLogLog:
+    """
+    HyperLogLog estimator of the number of different tokens, 2^p registers of one byte
+    """
+
+    def __init__(self, p=14):
+        self.p = p
+        self.m = 1 << p
+        self.registers = np.zeros(self.m, dtype=np.uint8)
+        self.alpha = 0.7213 / (1 + 1.079 / self.m)
+
+    def update(self, tokens):
+        if not tokens:
+            return
+        h = np.array([hash(t) for t in tokens], dtype=np.int64).view(np.uint64)
+        idx = (h >> np.uint64(64 - self.p)).astype(np.int64)
+        rest = h & np.uint64((1 << (64 - self.p)) - 1)
+        # rank = position of the first 1 bit in the remaining 64 - p bits
+        bits = np.zeros(len(rest), dtype=np.int64)
+        nonzero = rest > 0
+        bits[nonzero] = np.floor(np.log2(rest[nonzero].astype(np.float64))).astype(np.int64) + 1
+        rank = (64 - self.p) - bits + 1
+        np.maximum.at(self.registers, idx, rank.astype(np.uint8))
+
+    def __len__(self):
+        estimate = self.alpha * self.m ** 2 / np.sum(2.0 ** -self.registers.astype(np.float64))
+        zeros = np.count_nonzero(self.registers == 0)
+        if estimate <= 2.5 * self.m and zeros:
+            estimate = self.m * np.log(self.m / zeros)  # small range correction (linear counting)
+        return int(round(estimate))
+
+
+def heaps_points(texts, analyzer, interval, vocabulary, allowed):
+    """
+    Reads the texts in order and takes a point (total words, different words) every interval words
+    and at the end. Only the words made of allowed characters are counted
+
+    :param texts: iterable of texts
+    :param analyzer: function text -> list of words
+    :param vocabulary: set like object (update and len)
+    :return: the lists of total words and different words
+    """
+    totalWords = []
+    difWords = []
+    total = 0
+    checkpoint = interval
+    for text in texts:
+        words = [w for w in analyzer(text) if allowed.issuperset(w)]
+        pos = 0
+        while pos < len(words):
+            take = min(len(words) - pos, checkpoint - total)
+            vocabulary.update(words[pos:pos + take])
+            total += take
+            pos += take
+            if total == checkpoint:
+                totalWords.append(total)
+                difWords.append(len(vocabulary))
+                checkpoint += interval
+    if total and (not totalWords or totalWords[-1] != total):
+        totalWords.append(total)
+        difWords.append(len(vocabulary))
+    return totalWords, difWords
+
+
 def plot(totalWordsNoveli, difWordsNoveli):
+    totalWordsNoveli = np.array(totalWordsNoveli, dtype=np.float64)
+    difWordsNoveli = np.array(difWordsNoveli, dtype=np.float64)
 
     # dibuixem els nostres resultats
     plt.plot(totalWordsNoveli, difWordsNoveli, "b", label="Our results")
@@ -57,11 +137,30 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--index', default=None, required=False, help='Index to search')
     parser.add_argument('--alpha', action='store_true', default=False, help='Sort words alphabetically')
+    parser.add_argument('--cache', default=None, help='Local term vector cache file (SQLite)')
+    parser.add_argument('--path', default=None, help='Read the files under this path once instead of the indices')
+    parser.add_argument('--interval', default=10000, type=int, help='Words between points with --path')
+    parser.add_argument('--hll', action='store_true', default=False, help='Estimate the vocabulary with HyperLogLog')
+    parser.add_argument('--precision', default=14, type=int, help='HyperLogLog registers are 2^precision')
+    parser.add_argument('--token', default='standard', choices=list(tokenizers), help='Text tokenizer with --path')
+    parser.add_argument('--filter', default=['lowercase'], nargs=argparse.REMAINDER, help='Text filters with --path')
     args = parser.parse_args()
 
+    if args.path:
+        vocabulary = HyperLogLog(args.precision) if args.hll else set()
+        texts = (read_file(f) for f in generate_files_list(args.path))
+        totalWords, difWords = heaps_points(texts, Analyzer(args.token, args.filter), args.interval, vocabulary,
+                                            set(string.ascii_lowercase + string.ascii_uppercase))
+        for total, dif in zip(totalWords, difWords):
+            print(f'{total}, {dif}')
+        plot(totalWords, difWords)
+        sys.exit()
+
     try:
 
         client = Elasticsearch(timeout=1000)
+        if args.cache:
+            client = TermVectorCache(client, args.cache)
 
         difWordsNoveli = []
         totalWordsNoveli = []
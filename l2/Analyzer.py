@@ -0,0 +1,107 @@
+"""
+.. module:: Analyzer
+
+Analyzer
+******
+
+:Description: Analyzer
+
+    Python approximation of the Elasticsearch analysis chains built by IndexFilesPreprocess.py
+    (--token and --filter), so the corpus can be tokenized without a cluster
+
+    Tokenizers: standard, classic (words and numbers, joined by internal ' and .), letter, whitespace
+
+    Filters: lowercase, asciifolding, stop, english_stop, length_filter (2 to 20 characters),
+    porter_stem, stemmer, snowball (these three need nltk)
+
+    kstem and the ngram/word delimiter filters have no equivalent here
+
+:Authors:
+    bejar
+
+:Version:
+
+:Date:
+"""
+
+import re
+import unicodedata
+
+__author__ = 'bejar'
+
+# Lucene's default English stop words (the 'stop' filter)
+STOP_WORDS = frozenset(['a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'if', 'in', 'into', 'is',
+                        'it', 'no', 'not', 'of', 'on', 'or', 'such', 'that', 'the', 'their', 'then', 'there',
+                        'these', 'they', 'this', 'to', 'was', 'will', 'with'])
+
+# runs of word characters (not only underscores), joined by ' or . between letters and by . or , between digits
+WORD = r"(?=\w*[^\W_])\w+(?:(?:(?<=[^\W\d_])['’.](?=[^\W\d_])|(?<=\d)[.,](?=\d))\w+)*"
+
+tokenizers = {
+    'standard': re.compile(WORD).findall,
+    'classic': re.compile(WORD).findall,
+    'letter': re.compile(r"[^\W\d_]+").findall,
+    'whitespace': str.split,
+}
+
+
+def asciifolding(token):
+    return unicodedata.normalize('NFKD', token).encode('ascii', 'ignore').decode('ascii') or token
+
+
+def stemmer(name):
+    """
+    Returns the stem function of an nltk stemmer
+    """
+    try:
+        from nltk.stem import PorterStemmer, SnowballStemmer
+    except ImportError:
+        raise NameError(f'Filter {name} needs nltk (pip install nltk)')
+    if name == 'snowball':
+        return SnowballStemmer('english').stem
+    return PorterStemmer().stem
+
+
+def token_filter(name):
+    """
+    Returns the filter as a function that receives a list of tokens and returns the filtered list
+    """
+    if name == 'lowercase':
+        return lambda tokens: [t.lower() for t in tokens]
+    if name == 'asciifolding':
+        return lambda tokens: [asciifolding(t) for t in tokens]
+    if name in ('stop', 'english_stop'):
+        return lambda tokens: [t for t in tokens if t not in STOP_WORDS]
+    if name == 'length_filter':
+        return lambda tokens: [t for t in tokens if 2 <= len(t) <= 20]
+    if name in ('porter_stem', 'stemmer', 'snowball'):
+        stem = stemmer(name)
+        return lambda tokens: [stem(t) for t in tokens]
+    raise NameError(f'Filter {name} is not available without Elasticsearch')
+
+
+class Analyzer:
+    """
+    Tokenizer followed by a chain of filters, analyzer(text) returns the list of terms of the text
+    """
+
+    def __init__(self, token='standard', filters=('lowercase',)):
+        if token not in tokenizers:
+            raise NameError(f'Tokenizer {token} is not available without Elasticsearch')
+        self.token = token
+        self.filters = list(filters)
+        self.tokenize = tokenizers[token]
+        self.chain = [token_filter(f) for f in self.filters]
+
+    def __call__(self, text):
+        tokens = self.tokenize(text)
+        for f in self.chain:
+            tokens = f(tokens)
+        return tokens
+
+    def __getstate__(self):
+        # the filters are closures, send only the configuration to other processes
+        return {'token': self.token, 'filters': self.filters}
+
+    def __setstate__(self, state):
+        self.__init__(state['token'], state['filters'])
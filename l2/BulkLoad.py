@@ -0,0 +1,118 @@
+"""
+.. module:: BulkLoad
+
+BulkLoad
+******
+
+:Description: BulkLoad
+
+    Index settings profile for bulk loads, used by the indexing scripts (--bulkprofile)
+
+    While the documents are indexed refresh is disabled, there are no replicas and the translog is
+    flushed less often; afterwards the previous settings are restored, the index refreshed and
+    force merged to one segment
+
+    bulk_load() does both around a block of code; the settings are restored even if the block raises
+    (the force merge is skipped then)
+
+        with bulk_load(client, index, args.bulkprofile):
+            index_files(client, lfiles, index)
+
+    https://www.elastic.co/guide/en/elasticsearch/reference/current/tune-for-indexing-speed.html
+
+:Authors:
+    bejar
+
+:Version:
+
+:Date:
+"""
+
+from contextlib import contextmanager
+import time
+
+__author__ = 'bejar'
+
+BULK_SETTINGS = {
+    'refresh_interval': '-1',
+    'number_of_replicas': 0,
+    'translog.flush_threshold_size': '1gb',
+}
+
+
+def index_setting(settings, name):
+    """
+    Value of a setting of the 'index' group, given as a dotted name, in a get_settings answer
+    """
+    value = settings.get('index', {})
+    for key in name.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+def start_bulk_load(client, index):
+    """
+    Applies the bulk load settings to an index and returns the previous values to restore them
+
+    :param client:
+    :param index:
+    :return:
+    """
+    answer = client.indices.get_settings(index=index, include_defaults=True)[index]
+    previous = {}
+    for name in BULK_SETTINGS:
+        value = index_setting(answer.get('settings', {}), name)
+        if value is None:
+            value = index_setting(answer.get('defaults', {}), name)
+        previous[name] = value
+    client.indices.put_settings(index=index, body={'index': BULK_SETTINGS})
+    print(f'Bulk load settings {BULK_SETTINGS} (previous {previous})')
+    return previous
+
+
+def end_bulk_load(client, index, previous, max_num_segments=1, merge=True):
+    """
+    Restores the settings changed by start_bulk_load, refreshes and force merges the index
+
+    :param client:
+    :param index:
+    :param previous:
+    :param max_num_segments:
+    :param merge: False to only restore the settings and refresh (the load did not finish)
+    :return:
+    """
+    time1 = time.time()
+    client.indices.put_settings(index=index, body={'index': previous})
+    client.indices.refresh(index=index)
+    time2 = time.time()
+    if not merge:
+        print(f'Settings restored and index refreshed in {time2 - time1:.2f}s')
+        return
+    client.indices.forcemerge(index=index, max_num_segments=max_num_segments)
+    time3 = time.time()
+    print(f'Settings restored and index refreshed in {time2 - time1:.2f}s, force merged in {time3 - time2:.2f}s')
+
+
+@contextmanager
+def bulk_load(client, index, enabled=True):
+    """
+    Applies the bulk load settings while the block runs (if enabled), the previous settings are restored
+    when it ends or raises
+
+    :param client:
+    :param index:
+    :param enabled:
+    :return:
+    """
+    if not enabled:
+        yield
+        return
+    previous = start_bulk_load(client, index)
+    finished = False
+    try:
+        yield
+        finished = True
+    finally:
+        end_bulk_load(client, index, previous, merge=finished)
@@ -0,0 +1,182 @@
+"""
+.. module:: CompareAnalyzers
+
+CompareAnalyzers
+*************
+
+:Description: CompareAnalyzers
+
+    Compares several analysis chains (tokenizer + filters of IndexFilesPreprocess.py) on the files under
+    a directory (--path) reading the corpus only once
+
+    Every chain has its own index (--prefix + name). The files are read in chunks of --chunk documents and
+    every chunk is sent to all the indices, so the indexing time of each chain is measured separately.
+    Then the vocabulary of each index is counted in the server (CountWords.py --mode aggregation) and a
+    table with the vocabulary size, the number of tokens and the times is printed
+
+    A chain is given as name=tokenizer:filter,filter,... (--chain can be repeated), by default the
+    chains of the count files of this directory (noStemCount/novelsStandardCount, porterCount, kstemCount,
+    snowballCount, novelsWhitespaceCount, novelsClassicCount, novelsLetterCount) are compared
+
+    With --output the counts of every chain are written to a file per chain (same format as CountWords.py)
+
+:Authors: bejar
+
+
+:Version:
+
+:Created on:
+
+"""
+
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import bulk
+from elasticsearch.exceptions import NotFoundError
+from elasticsearch_dsl import Index, analyzer, tokenizer
+import argparse
+import codecs
+import time
+
+from IndexFilesPreprocess import generate_files_list, length_filter, word_delimiter_filter, ngram_filter, \
+    edge_ngram_filter
+from CountWords import count_words_aggregation
+
+__author__ = 'bejar'
+
+FILTERS = {
+    'lowercase': 'lowercase',
+    'asciifolding': 'asciifolding',
+    'stop': 'stop',
+    'stemmer': 'stemmer',
+    'porter_stem': 'porter_stem',
+    'kstem': 'kstem',
+    'snowball': 'snowball',
+    'english_stop': 'english_stop',
+    'length_filter': length_filter,
+    'word_delimiter_filter': word_delimiter_filter,
+    'ngram_filter': ngram_filter,
+    'edge_ngram_filter': edge_ngram_filter
+}
+
+DEFAULT_CHAINS = [
+    'nostem=standard:lowercase',
+    'porter=standard:lowercase,porter_stem',
+    'kstem=standard:lowercase,kstem',
+    'snowball=standard:lowercase,snowball',
+    'whitespace=whitespace:lowercase',
+    'classic=classic:lowercase',
+    'letter=letter:lowercase',
+]
+
+
+def parse_chain(spec):
+    """
+    Parses name=tokenizer:filter,filter,... into (name, tokenizer, list of filters)
+    """
+    name, _, chain = spec.partition('=')
+    token, _, filters = chain.partition(':')
+    if not name or not token:
+        raise NameError(f'Invalid chain {spec}, must be name=tokenizer:filter,filter,...')
+    filters = [f for f in filters.split(',') if f]
+    for f in filters:
+        if f not in FILTERS:
+            raise NameError(f'Invalid filter {f}. Must be a subset of: {", ".join(FILTERS)}')
+    return name, token, filters
+
+
+def create_index(client, index, token, filters):
+    """
+    Creates (dropping it if it exists) an index with one shard, the chain as default analyzer, 'path' as
+    keyword and fielddata in 'text' for the aggregations
+    """
+    ind = Index(index, using=client)
+    try:
+        ind.delete()
+    except NotFoundError:
+        pass
+    ind.settings(number_of_shards=1)
+    ind.analyzer(analyzer('default', type='custom', tokenizer=tokenizer(token),
+                          filter=[FILTERS[f] for f in filters]))
+    ind.create()
+    client.indices.put_mapping(index=index, body={"properties": {"path": {"type": "keyword"},
+                                                                 "text": {"type": "text", "fielddata": True}}})
+
+
+def read_chunks(lfiles, size):
+    """
+    Generates the (path, text) of the files in lists of size files, every file is read once
+    """
+    chunk = []
+    for f in lfiles:
+        with codecs.open(f, "r", encoding='iso-8859-1') as ftxt:
+            chunk.append((f, ftxt.read()))
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def index_chains(client, lfiles, indices, chunk_size=500):
+    """
+    Reads the files once and sends every chunk of documents to all the indices
+
+    :return: seconds spent reading the files and dict index -> seconds spent indexing
+    """
+    timings = {index: 0.0 for index in indices}
+    read_time = 0.0
+    time1 = time.time()
+    for docs in read_chunks(lfiles, chunk_size):
+        read_time += time.time() - time1
+        for index in indices:
+            time1 = time.time()
+            bulk(client, [{'_op_type': 'index', '_index': index, 'path': f, 'text': text} for f, text in docs])
+            timings[index] += time.time() - time1
+        time1 = time.time()
+    for index in indices:
+        time1 = time.time()
+        client.indices.refresh(index=index)
+        timings[index] += time.time() - time1
+    return read_time, timings
+
+
+def write_counts(voc, filename):
+    with open(filename, 'w', encoding='utf-8') as fout:
+        for pal, cnt in sorted(voc.items(), key=lambda x: x[1]):
+            fout.write(f'{cnt}, {pal}\n')
+        fout.write('--------------------\n')
+        fout.write(f'{len(voc)} Words\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', required=True, default=None, help='Path to the files')
+    parser.add_argument('--prefix', default='compare-', help='Prefix of the index of every chain')
+    parser.add_argument('--chain', default=None, action='append', help='Analysis chain name=tokenizer:filter,...')
+    parser.add_argument('--chunk', default=500, type=int, help='Documents read and sent per bulk request')
+    parser.add_argument('--page', default=1000, type=int, help='Terms per page when counting the vocabulary')
+    parser.add_argument('--output', default=None, help='Prefix of the count files of every chain')
+    args = parser.parse_args()
+
+    chains = [parse_chain(spec) for spec in (args.chain or DEFAULT_CHAINS)]
+    indices = [args.prefix + name for name, _, _ in chains]
+
+    lfiles = generate_files_list(args.path)
+    print(f'Comparing {len(chains)} analysis chains on {len(lfiles)} files')
+
+    client = Elasticsearch(timeout=1000)
+    for index, (_, token, filters) in zip(indices, chains):
+        create_index(client, index, token, filters)
+
+    read_time, timings = index_chains(client, lfiles, indices, args.chunk)
+    print(f'Files read once in {read_time:.2f}s')
+
+    print('Chain\tTokenizer\tFilters\tVocabulary\tTokens\tIndexing (s)\tCounting (s)')
+    for index, (name, token, filters) in zip(indices, chains):
+        time1 = time.time()
+        voc = count_words_aggregation(client, index, args.page)
+        time2 = time.time()
+        print(f'{name}\t{token}\t{",".join(filters)}\t{len(voc)}\t{sum(voc.values())}\t'
+              f'{timings[index]:.2f}\t{time2 - time1:.2f}')
+        if args.output:
+            write_counts(voc, f'{args.output}{name}')
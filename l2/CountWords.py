@@ -8,6 +8,18 @@ CountWords
 
     Generates a list with the counts and the words in the 'text' field of the documents in an index
 
+    --mode termvectors (default) adds up the term vectors of all the documents, --mode aggregation computes
+    the counts in the server: the vocabulary is paged with a composite terms aggregation and the total
+    frequency (ttf) of every page of terms is read from the term statistics of an artificial document. Term
+    statistics are per shard, the indices are created with a single shard
+
+    The aggregation needs fielddata in the 'text' field. The mapping of the index is not changed unless
+    --fielddata is given (it can not be undone and the fielddata is kept in the heap of the server)
+
+    --benchmark index1 index2 ... times both modes on every index
+
+    --postings file reads the total frequencies of the terms from a postings file (PostingsFile.py), no requests
+
 :Authors: bejar
     
 
@@ -21,43 +33,252 @@ from __future__ import print_function
 from elasticsearch import Elasticsearch
 from elasticsearch.helpers import scan
 from elasticsearch.exceptions import NotFoundError, TransportError
+from TermVectorCache import TermVectorCache
+from PostingsFile import PostingsFile
 
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import argparse
+import time
 
 __author__ = 'bejar'
 
+
+def scan_ids(client, index):
+    """
+    Generates the ids of all the documents of an index
+
+    :param client:
+    :param index:
+    :return:
+    """
+    for s in scan(client, index=index, query={"query": {"match_all": {}}}, _source=False):
+        yield s['_id']
+
+
+def chunks(ids, size):
+    """
+    Groups an iterable of ids in lists of size ids
+    """
+    chunk = []
+    for id in ids:
+        chunk.append(id)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def fetch_term_freqs(client, index, ids, retries=3, backoff=1.0):
+    """
+    Gets the term frequencies of the 'text' field of a list of documents with one mtermvectors request,
+    retrying with exponential backoff when the request fails
+
+    :return: list of dicts term -> frequency (one per document found) and number of documents that failed
+    """
+    for attempt in range(retries + 1):
+        try:
+            response = client.mtermvectors(index=index, body={'ids': ids}, fields=['text'],
+                                           positions=False, offsets=False, term_statistics=False)
+            break
+        except NotFoundError:
+            raise
+        except TransportError:
+            if attempt == retries:
+                return [], len(ids)
+            time.sleep(backoff * 2 ** attempt)
+
+    tfs = []
+    failed = 0
+    for doc in response['docs']:
+        if 'error' in doc or not doc.get('found', False):
+            failed += 1
+        elif 'text' in doc.get('term_vectors', {}):
+            terms = doc['term_vectors']['text']['terms']
+            tfs.append({t: terms[t]['term_freq'] for t in terms})
+    return tfs, failed
+
+
+def count_words(client, index, chunk_size=200, workers=4, max_inflight=8, retries=3, backoff=1.0):
+    """
+    Total frequency of every term of the 'text' field of an index. The term vectors are fetched with
+    mtermvectors requests of chunk_size documents, sent by a pool of workers threads with at most
+    max_inflight requests pending
+
+    :return: dict term -> frequency, number of documents counted and number of documents that failed
+    """
+    voc = {}
+    ndocs = 0
+    nfailed = 0
+
+    def merge(future):
+        nonlocal ndocs, nfailed
+        tfs, failed = future.result()
+        nfailed += failed
+        ndocs += len(tfs)
+        for tf in tfs:
+            for t, f in tf.items():
+                voc[t] = voc.get(t, 0) + f
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        for ids in chunks(scan_ids(client, index), chunk_size):
+            if len(pending) >= max_inflight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    merge(future)
+            pending.add(pool.submit(fetch_term_freqs, client, index, ids, retries, backoff))
+        for future in wait(pending).done:
+            merge(future)
+    return voc, ndocs, nfailed
+
+
+def vocabulary_pages(client, index, page_size=1000):
+    """
+    Generates the terms of the 'text' field of an index in pages of page_size terms with a composite
+    terms aggregation, the field needs fielddata
+
+    :param client:
+    :param index:
+    :param page_size:
+    :return:
+    """
+    after = None
+    while True:
+        composite = {"size": page_size, "sources": [{"term": {"terms": {"field": "text"}}}]}
+        if after is not None:
+            composite["after"] = after
+        response = client.search(index=index, body={"size": 0, "aggs": {"voc": {"composite": composite}}})
+        buckets = response['aggregations']['voc']['buckets']
+        if not buckets:
+            return
+        yield [b['key']['term'] for b in buckets]
+        after = response['aggregations']['voc'].get('after_key')
+        if after is None:
+            return
+
+
+def total_term_freqs(client, index, terms):
+    """
+    Total frequency in the index of a list of terms, from the term statistics of an artificial document that
+    contains the terms once. The whitespace analyzer keeps the terms as they are (they are already analyzed)
+
+    :return: dict term -> total term frequency
+    """
+    tv = client.termvectors(index=index, body={"doc": {"text": " ".join(terms)},
+                                               "per_field_analyzer": {"text": "whitespace"},
+                                               "term_statistics": True, "field_statistics": False,
+                                               "positions": False, "offsets": False})
+    if 'text' not in tv['term_vectors']:
+        return {}
+    terms = tv['term_vectors']['text']['terms']
+    return {t: terms[t].get('ttf', 0) for t in terms}
+
+
+def has_fielddata(client, index):
+    """
+    True if the 'text' field of an index has fielddata (needed to aggregate on an analyzed text field)
+    """
+    mapping = next(iter(client.indices.get_mapping(index=index).values()))['mappings']
+    return mapping.get('properties', {}).get('text', {}).get('fielddata', False)
+
+
+def count_words_aggregation(client, index, page_size=1000, fielddata=False):
+    """
+    Total frequency of every term of the 'text' field of an index computed by the server,
+    two requests per page of page_size terms instead of one per document
+
+    :param fielddata: enable fielddata in the 'text' field if it is not enabled, otherwise it is an error
+    :return: dict term -> frequency
+    """
+    if not has_fielddata(client, index):
+        if not fielddata:
+            raise NameError(f"The 'text' field of index {index} has no fielddata, the aggregation mode needs it "
+                            f"(--fielddata enables it, the mapping change can not be undone)")
+        client.indices.put_mapping(index=index, body={"properties": {"text": {"type": "text", "fielddata": True}}})
+    voc = {}
+    for terms in vocabulary_pages(client, index, page_size):
+        voc.update(total_term_freqs(client, index, terms))
+    return voc
+
+
+def count_words_postings(postings):
+    """
+    Total frequency of every term of a postings file, read from its ttf section
+
+    :return: dict term -> frequency
+    """
+    return dict(zip(postings.vocabulary, postings.ttf.tolist()))
+
+
+def benchmark(client, indexes, args):
+    """
+    Times the termvectors and the aggregation modes on every index and checks that they give the same counts
+    """
+    print('Index\tWords\tTermvectors (s)\tAggregation (s)\tSame counts')
+    for index in indexes:
+        time1 = time.time()
+        voc_tv, _, _ = count_words(client, index, args.chunk, args.workers, args.inflight, args.retries, args.backoff)
+        time2 = time.time()
+        voc_agg = count_words_aggregation(client, index, args.page, args.fielddata)
+        time3 = time.time()
+        print(f'{index}\t{len(voc_tv)}\t{time2 - time1:.2f}\t{time3 - time2:.2f}\t{voc_tv == voc_agg}')
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--index', default=None, required=True, help='Index to search')
+    parser.add_argument('--index', default=None, help='Index to search')
     parser.add_argument('--alpha', action='store_true', default=False, help='Sort words alphabetically')
+    parser.add_argument('--cache', default=None, help='Local term vector cache file (SQLite)')
+    parser.add_argument('--chunk', default=200, type=int, help='Documents per mtermvectors request')
+    parser.add_argument('--workers', default=4, type=int, help='Threads sending mtermvectors requests')
+    parser.add_argument('--inflight', default=8, type=int, help='Maximum number of pending requests')
+    parser.add_argument('--retries', default=3, type=int, help='Retries of a failed request')
+    parser.add_argument('--backoff', default=1.0, type=float, help='Seconds before the first retry (doubled each time)')
+    parser.add_argument('--mode', default='termvectors', choices=['termvectors', 'aggregation'],
+                        help='Add up the document term vectors or compute the counts in the server')
+    parser.add_argument('--page', default=1000, type=int, help='Terms per page in aggregation mode')
+    parser.add_argument('--fielddata', default=False, action='store_true',
+                        help='Enable fielddata in the text field for the aggregation mode if needed')
+    parser.add_argument('--benchmark', default=None, nargs='+', help='Indices where both modes are compared')
+    parser.add_argument('--postings', default=None, help='Postings file (PostingsFile.py) to read instead of the index')
     args = parser.parse_args()
 
+    if args.index is None and args.benchmark is None and args.postings is None:
+        parser.error('--index, --benchmark or --postings is required')
+
     index = args.index
 
     try:
         client = Elasticsearch(timeout=1000)
-        voc = {}
-        sc = scan(client, index=index, query={"query" : {"match_all": {}}})
-        for s in sc:
-            try:
-                tv = client.termvectors(index=index, id=s['_id'], fields=['text'])
-                if 'text' in tv['term_vectors']:
-                    for t in tv['term_vectors']['text']['terms']:
-                        if t in voc:
-                            voc[t] += tv['term_vectors']['text']['terms'][t]['term_freq']
-                        else:
-                            voc[t] = tv['term_vectors']['text']['terms'][t]['term_freq']
-            except TransportError:
-                pass
-        lpal = []
-
-        for v in voc:
-            lpal.append((v.encode("utf-8", "ignore"), voc[v]))
-
-
-        for pal, cnt in sorted(lpal, key=lambda x: x[0 if args.alpha else 1]):
-            print(f'{cnt}, {pal.decode("utf-8")}')
-        print('--------------------')
-        print(f'{len(lpal)} Words')
+        if args.cache:
+            client = TermVectorCache(client, args.cache)
+
+        if args.benchmark:
+            index = ', '.join(args.benchmark)
+            benchmark(client, args.benchmark, args)
+        else:
+            if args.postings:
+                postings = PostingsFile(args.postings)
+                voc = count_words_postings(postings)
+                ndocs, nfailed = postings.doc_count(), 0
+            elif args.mode == 'aggregation':
+                voc = count_words_aggregation(client, index, args.page, args.fielddata)
+                ndocs, nfailed = None, 0
+            else:
+                voc, ndocs, nfailed = count_words(client, index, args.chunk, args.workers, args.inflight,
+                                                  args.retries, args.backoff)
+            lpal = []
+
+            for v in voc:
+                lpal.append((v.encode("utf-8", "ignore"), voc[v]))
+
+
+            for pal, cnt in sorted(lpal, key=lambda x: x[0 if args.alpha else 1]):
+                print(f'{cnt}, {pal.decode("utf-8")}')
+            print('--------------------')
+            print(f'{len(lpal)} Words')
+            if ndocs is not None:
+                print(f'{ndocs} Documents ({nfailed} failed)')
     except NotFoundError:
         print(f'Index {index} does not exists')
\ No newline at end of file
@@ -0,0 +1,107 @@
+"""
+.. module:: CountWordsLocal
+
+CountWordsLocal
+*************
+
+:Description: CountWordsLocal
+
+    Generates a list with the counts and the words of the files under a directory (--path) without
+    Elasticsearch, same output as CountWords.py
+
+    The files are tokenized with the Python equivalent (Analyzer.py) of the --token and --filter options
+    of IndexFilesPreprocess.py by a pool of --workers processes, and the per process counters are merged
+    in pairs (tree reduction)
+
+    --filter must be always the last flag
+
+:Authors: bejar
+
+
+:Version:
+
+:Created on:
+
+"""
+
+from collections import Counter
+from multiprocessing import Pool
+import argparse
+import codecs
+import os
+
+from Analyzer import Analyzer, tokenizers
+from ReadFiles import generate_files_list
+
+__author__ = 'bejar'
+
+
+def read_file(f):
+    """
+    Text of a file, decoded as the indexing scripts do
+    """
+    with codecs.open(f, "r", encoding='iso-8859-1') as ftxt:
+        return ftxt.read()
+
+
+def count_files(task):
+    """
+    Counter of the terms of a list of files
+    """
+    analyzer, lfiles = task
+    voc = Counter()
+    for f in lfiles:
+        voc.update(analyzer(read_file(f)))
+    return voc
+
+
+def merge_counters(pair):
+    first, second = pair
+    first.update(second)
+    return first
+
+
+def tree_reduce(pool, counters):
+    """
+    Merges a list of counters adding them in pairs, in parallel, until only one is left
+    """
+    if not counters:
+        return Counter()
+    while len(counters) > 1:
+        pairs = list(zip(counters[0::2], counters[1::2]))
+        odd = [counters[-1]] if len(counters) % 2 else []
+        counters = pool.map(merge_counters, pairs) + odd
+    return counters[0]
+
+
+def count_words_local(lfiles, analyzer, workers=4, files_per_task=8):
+    """
+    Total frequency of every term of the files, tokenized with analyzer by a pool of workers processes
+    """
+    tasks = [(analyzer, lfiles[i:i + files_per_task]) for i in range(0, len(lfiles), files_per_task)]
+    with Pool(workers) as pool:
+        counters = pool.map(count_files, tasks)
+        return tree_reduce(pool, counters)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', required=True, default=None, help='Path to the files')
+    parser.add_argument('--alpha', action='store_true', default=False, help='Sort words alphabetically')
+    parser.add_argument('--workers', default=os.cpu_count(), type=int, help='Number of processes')
+    parser.add_argument('--token', default='standard', choices=list(tokenizers), help='Text tokenizer')
+    parser.add_argument('--filter', default=['lowercase'], nargs=argparse.REMAINDER, help='Text filter: lowercase, '
+                        'asciifolding, stop, english_stop, length_filter, porter_stem, stemmer, snowball')
+    args = parser.parse_args()
+
+    voc = count_words_local(generate_files_list(args.path), Analyzer(args.token, args.filter), args.workers)
+
+    lpal = []
+
+    for v in voc:
+        lpal.append((v.encode("utf-8", "ignore"), voc[v]))
+
+    for pal, cnt in sorted(lpal, key=lambda x: x[0 if args.alpha else 1]):
+        print(f'{cnt}, {pal.decode("utf-8")}')
+    print('--------------------')
+    print(f'{len(lpal)} Words')
@@ -0,0 +1,155 @@
+"""
+.. module:: IncrementalIndex
+
+IncrementalIndex
+******
+
+:Description: IncrementalIndex
+
+    Incremental indexing for the indexing scripts (--incremental manifest.json)
+
+    The manifest stores for every indexed file its path -> (mtime, size, content hash) and the
+    configuration of the index (analyzer). The documents are indexed with the path as _id, so a
+    changed file replaces its document and a removed file is deleted by its path.
+
+    Only the files whose mtime or size changed are read; if their content hash is the same only the
+    manifest is updated. The manifest is updated with the operations that succeeded, so a failed run
+    is retried the next time.
+
+    If the manifest does not exist, its configuration is different or the index does not exist the
+    index is rebuilt from scratch
+
+    run_incremental() is what the indexing scripts do with --incremental:
+
+        manifest = run_incremental(client, lfiles, index, args.incremental, config)
+        if manifest is None:  # only the changes were sent
+            sys.exit(0)
+        # rebuild the index and index_changes() with the new manifest
+
+:Authors:
+    bejar
+
+:Version:
+
+:Date:
+"""
+
+from elasticsearch.helpers import streaming_bulk
+import codecs
+import hashlib
+import json
+import os
+import time
+
+from BulkLoad import bulk_load
+from TermVectorCache import TermVectorCache
+
+__author__ = 'bejar'
+
+
+def load_manifest(path):
+    """
+    Reads a manifest, an empty one if the file does not exist
+    """
+    if not os.path.exists(path):
+        return {'config': None, 'files': {}}
+    with open(path, 'r') as fman:
+        return json.load(fman)
+
+
+def save_manifest(path, manifest):
+    """
+    Writes the manifest to a temporary file and replaces the old one, so it is never left half written
+    """
+    with open(path + '.tmp', 'w') as fman:
+        json.dump(manifest, fman)
+    os.replace(path + '.tmp', path)
+
+
+def content_hash(text):
+    return hashlib.sha1(text.encode('utf-8', 'surrogateescape')).hexdigest()
+
+
+def generate_changes(lfiles, index, files, pending, stats):
+    """
+    Generates the index operations of the new and changed files and the delete operations of the
+    files that are no longer in lfiles. The new manifest entries are left in pending[path] until
+    the operation succeeds (None for the deletions)
+    """
+    for f in lfiles:
+        st = os.stat(f)
+        old = files.get(f)
+        if old is not None and old[0] == st.st_mtime and old[1] == st.st_size:
+            continue
+        with codecs.open(f, "r", encoding='iso-8859-1') as ftxt:
+            text = ftxt.read()
+        digest = content_hash(text)
+        if old is not None and old[2] == digest:
+            files[f] = [st.st_mtime, st.st_size, digest]  # touched but not changed
+            stats['touched'] += 1
+            continue
+        stats['added' if old is None else 'changed'] += 1
+        pending[f] = [st.st_mtime, st.st_size, digest]
+        yield {'_op_type': 'index', '_index': index, '_id': f, 'path': f, 'text': text}
+
+    current = set(lfiles)
+    for f in [f for f in files if f not in current]:
+        stats['removed'] += 1
+        pending[f] = None
+        yield {'_op_type': 'delete', '_index': index, '_id': f}
+
+
+def index_changes(client, lfiles, index, manifest, chunk_size=500, max_chunk_bytes=100 * 1024 * 1024):
+    """
+    Sends to the index only the operations for the files added, changed or removed since the manifest was
+    written and updates the manifest with the operations that succeeded
+    :return: list of the paths of the documents indexed or deleted, number of errors
+    """
+    files = manifest['files']
+    pending = {}
+    stats = {'added': 0, 'changed': 0, 'removed': 0, 'touched': 0}
+    actions = generate_changes(lfiles, index, files, pending, stats)
+
+    time1 = time.time()
+    done = []
+    errors = 0
+    for ok, item in streaming_bulk(client, actions, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes,
+                                   raise_on_error=False, raise_on_exception=False):
+        op, result = next(iter(item.items()))
+        f = result['_id']
+        # deleting a document that is not in the index is not an error
+        if ok or (op == 'delete' and result.get('status') == 404):
+            if pending[f] is None:
+                files.pop(f, None)
+            else:
+                files[f] = pending[f]
+            done.append(f)
+        else:
+            errors += 1
+    client.indices.refresh(index=index)
+    print(f'{stats["added"]} added, {stats["changed"]} changed, {stats["removed"]} removed, '
+          f'{stats["touched"]} touched without changes, {errors} errors in {time.time() - time1:.2f}s')
+    return done, errors
+
+
+def run_incremental(client, lfiles, index, manifest_path, config, bulkprofile=False, cache=None, chunk_size=500,
+                    max_chunk_bytes=100 * 1024 * 1024):
+    """
+    Sends only the changes since the last run if the manifest was written with the same configuration
+    (analyzer) and the index exists; with bulkprofile the bulk load settings are used (BulkLoad.py) and
+    with cache the term vector cache file of the index is dropped if some document changed
+
+    :return: None if the changes were sent, otherwise the empty manifest to rebuild the index with
+    """
+    manifest = load_manifest(manifest_path)
+    if manifest['config'] == config and client.indices.exists(index=index):
+        print('Indexing only the files that changed ...')
+        with bulk_load(client, index, bulkprofile):
+            done, _ = index_changes(client, lfiles, index, manifest, chunk_size=chunk_size,
+                                    max_chunk_bytes=max_chunk_bytes)
+            save_manifest(manifest_path, manifest)
+        if cache and done:
+            TermVectorCache(client, cache).invalidate(index)
+        return None
+    # first run or different analyzer, the index is rebuilt
+    return {'config': config, 'files': {}}
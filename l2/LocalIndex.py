@@ -0,0 +1,341 @@
+"""
+.. module:: LocalIndex
+
+LocalIndex
+******
+
+:Description: LocalIndex
+
+    In process inverted index of the files under a directory, a stand-in for Elasticsearch in the offline
+    analysis scripts (no service, no network round trips)
+
+    The text is analyzed with Analyzer.py (same --token and --filter as IndexFilesPreprocess.py). The
+    postings of every term are the gaps between document numbers and the term frequencies, varint encoded
+    in byte arrays; the document frequency, total term frequency and length of every document are kept
+    in arrays, and every document has its (term, frequency) vector for the term vectors
+
+    LocalClient answers termvectors and mtermvectors with the same structure as Elasticsearch (with
+    term_statistics and field_statistics), so it can be passed as the client of document_term_vector(),
+    TFIDFIndex (TFIDFViewer.py) or fetch_term_freqs() (CountWords.py). doc_count(), search_file_by_path()
+    and search() (AND query of words with word^boost, BM25 scores) have the same call shape as the
+    functions of the scripts
+
+        client = LocalClient({'novels': LocalIndex.from_files(generate_files_list('novels'))})
+        document_term_vector(client, 'novels', search_file_by_path(client, 'novels', path))
+
+:Authors:
+    bejar
+
+:Version:
+
+:Date:
+"""
+
+from collections import Counter
+from array import array
+import argparse
+import codecs
+import time
+
+import numpy as np
+
+from Analyzer import Analyzer, tokenizers
+from ReadFiles import generate_files_list
+
+__author__ = 'bejar'
+
+
+def varint(n):
+    """
+    Varint encoding of a non negative integer: 7 bits per byte, the high bit set in all the bytes but the last
+    """
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return out
+
+
+def encode_varints(values):
+    """
+    Varint encoding of an array of non negative integers (vectorized)
+
+    :return: bytes
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    if len(values) == 0:
+        return b''
+    nbytes = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        nbytes += rest > 0
+        rest >>= np.uint64(7)
+    # position of every byte in its value
+    starts = np.cumsum(nbytes) - nbytes
+    shift = np.arange(nbytes.sum()) - np.repeat(starts, nbytes)
+    groups = np.repeat(values, nbytes)
+    out = ((groups >> (np.uint64(7) * shift.astype(np.uint64))) & np.uint64(0x7f)).astype(np.uint8)
+    more = np.ones(len(out), dtype=bool)  # the last byte of every value is the one without the high bit
+    more[starts + nbytes - 1] = False
+    out[more] |= 0x80
+    return out.tobytes()
+
+
+def decode_varints(buf):
+    """
+    Decodes a buffer (bytes, bytearray, memoryview or uint8 array) of varints into an int64 array (vectorized)
+    """
+    b = np.frombuffer(buf, dtype=np.uint8)
+    if len(b) == 0:
+        return np.empty(0, dtype=np.int64)
+    ends = np.flatnonzero(b < 0x80)
+    starts = np.empty(len(ends), dtype=np.int64)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    shift = np.arange(len(b)) - np.repeat(starts, ends - starts + 1)
+    parts = (b & 0x7f).astype(np.int64) << (7 * shift)
+    return np.add.reduceat(parts, starts)
+
+
+def bm25_search(index, query, nhits=10, k1=1.2, b=0.75):
+    """
+    AND query of a list of words (word^boost changes the importance of the word) in a LocalIndex, scored
+    with BM25 as Elasticsearch does. Every word is analyzed, all its terms must be in the documents
+
+    :return: number of documents found and list of (id, score, path) of the best nhits
+    """
+    terms = []
+    for word in query:
+        word, _, boost = word.partition('^')
+        for t in index.analyzer(word):
+            terms.append((t, float(boost) if boost else 1.0))
+    if not terms:
+        return 0, []
+
+    postings = [(t, boost) + index.documents(t) for t, boost in terms]
+    postings.sort(key=lambda p: len(p[2]))
+    docs = postings[0][2]
+    for _, _, pdocs, _ in postings[1:]:
+        docs = np.intersect1d(docs, pdocs, assume_unique=True)
+    if len(docs) == 0:
+        return 0, []
+
+    n = index.doc_count()
+    lengths = index.doc_lengths()
+    norm = k1 * (1 - b + b * lengths[docs] / lengths.mean())
+    scores = np.zeros(len(docs))
+    for _, boost, pdocs, pfreqs in postings:
+        tf = pfreqs[np.searchsorted(pdocs, docs)]
+        idf = np.log(1 + (n - len(pdocs) + 0.5) / (len(pdocs) + 0.5))
+        scores += boost * idf * tf * (k1 + 1) / (tf + norm)
+
+    best = np.argsort(-scores, kind='stable')[:nhits]
+    return len(docs), [(str(docs[i]), float(scores[i]), index.path(docs[i])) for i in best]
+
+
+class LocalIndex:
+    """
+    Inverted index of a set of documents (path, text) with the 'text' field statistics of Elasticsearch
+    """
+
+    def __init__(self, analyzer=None):
+        self.analyzer = Analyzer() if analyzer is None else analyzer
+        self.terms = {}  # term -> term number
+        self.vocabulary = []  # term number -> term
+        self.postings = []  # term number -> varints of the gaps between the documents that contain it
+        self.freqs = []  # term number -> varints of the frequencies in these documents
+        self.last = array('l')  # term number -> last document added to its postings
+        self.df = array('l')  # term number -> document frequency
+        self.ttf = array('q')  # term number -> total term frequency
+        self.paths = []  # document number -> path
+        self.by_path = {}  # path -> document number
+        self.lengths = array('l')  # document number -> number of tokens
+        self.vectors = []  # document number -> (array of term numbers, array of frequencies)
+        self._field_statistics = None
+
+    @classmethod
+    def from_files(cls, lfiles, analyzer=None):
+        """
+        Index of a list of files, read as the indexing scripts do
+        """
+        index = cls(analyzer)
+        for f in lfiles:
+            with codecs.open(f, "r", encoding='iso-8859-1') as ftxt:
+                index.add(f, ftxt.read())
+        return index
+
+    def add(self, path, text):
+        """
+        Adds a document, returns its id
+        """
+        doc = len(self.paths)
+        counts = Counter(self.analyzer(text))
+        tids = array('l')
+        tfs = array('l')
+        for t, f in counts.items():
+            tid = self.terms.get(t)
+            if tid is None:
+                tid = self.terms[t] = len(self.vocabulary)
+                self.vocabulary.append(t)
+                self.postings.append(bytearray())
+                self.freqs.append(bytearray())
+                self.last.append(0)
+                self.df.append(0)
+                self.ttf.append(0)
+            self.postings[tid] += varint(doc - self.last[tid])
+            self.freqs[tid] += varint(f)
+            self.last[tid] = doc
+            self.df[tid] += 1
+            self.ttf[tid] += f
+            tids.append(tid)
+            tfs.append(f)
+        self.paths.append(path)
+        self.by_path[path] = doc
+        self.lengths.append(sum(tfs))
+        self.vectors.append((tids, tfs))
+        self._field_statistics = None
+        return str(doc)
+
+    def doc_count(self):
+        return len(self.paths)
+
+    def documents(self, term):
+        """
+        Numbers of the documents that contain a term and the frequencies of the term in them (int64 arrays)
+        """
+        tid = self.terms.get(term)
+        if tid is None:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        return np.cumsum(decode_varints(self.postings[tid])), decode_varints(self.freqs[tid])
+
+    def field_statistics(self):
+        if self._field_statistics is None:
+            self._field_statistics = {'sum_doc_freq': int(sum(self.df)), 'doc_count': len(self.paths),
+                                      'sum_ttf': int(sum(self.ttf))}
+        return dict(self._field_statistics)
+
+    def term_vector(self, id, term_statistics=True, field_statistics=True):
+        """
+        termvectors answer of a document (only the 'text' field)
+        """
+        doc = int(id) if str(id).isdigit() else -1
+        if not 0 <= doc < len(self.paths):
+            return {'_id': id, 'found': False}
+        tids, tfs = self.vectors[doc]
+        terms = {}
+        for tid, f in zip(tids, tfs):
+            entry = {'term_freq': f}
+            if term_statistics:
+                entry['doc_freq'] = self.df[tid]
+                entry['ttf'] = self.ttf[tid]
+            terms[self.vocabulary[tid]] = entry
+        text = {'terms': terms}
+        if field_statistics:
+            text['field_statistics'] = self.field_statistics()
+        return {'_id': id, 'found': True, 'term_vectors': {'text': text} if terms else {}}
+
+    def doc_lengths(self):
+        return np.frombuffer(self.lengths, dtype=self.lengths.typecode)
+
+    def path(self, doc):
+        return self.paths[doc]
+
+    def search(self, query, nhits=10):
+        return bm25_search(self, query, nhits)
+
+
+class LocalClient:
+    """
+    The termvectors, mtermvectors and count calls of the Elasticsearch client over a dict name -> LocalIndex
+    (or PostingsFile)
+    """
+
+    def __init__(self, indices):
+        self.local = indices
+
+    def _index(self, index):
+        if index not in self.local:
+            raise NameError(f'Index {index} does not exists')
+        return self.local[index]
+
+    def termvectors(self, index, id=None, fields=None, term_statistics=False, field_statistics=True, **params):
+        answer = self._index(index).term_vector(id, term_statistics, field_statistics)
+        answer['_index'] = index
+        return answer
+
+    def mtermvectors(self, index, body, fields=None, term_statistics=False, field_statistics=True, **params):
+        return {'docs': [self.termvectors(index, id, fields, term_statistics, field_statistics)
+                         for id in body.get('ids', [])]}
+
+    def count(self, index):
+        return {'count': self._index(index).doc_count()}
+
+    def all_ids(self, index):
+        """
+        Generates the (id, path) of all the documents of an index (what scan returns for a match_all)
+        """
+        local = self._index(index)
+        for doc in range(local.doc_count()):
+            yield str(doc), local.path(doc)
+
+
+def doc_count(client, index):
+    """
+    Returns the number of documents in an index
+
+    :param client:
+    :param index:
+    :return:
+    """
+    return client.count(index=index)['count']
+
+
+def search_file_by_path(client, index, path):
+    """
+    Search for a file using its path
+
+    :param path:
+    :return:
+    """
+    doc = client._index(index).by_path.get(path)
+    if doc is None:
+        raise NameError(f'File [{path}] not found')
+    return str(doc)
+
+
+def search(client, index, query, nhits=10):
+    """
+    AND query of a list of words (word^number), returns the number of documents found and the list of
+    (id, score, path) of the best nhits
+    """
+    return client._index(index).search(query, nhits)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', required=True, default=None, help='Path to the files')
+    parser.add_argument('--nhits', default=10, type=int, help='Number of hits to return')
+    parser.add_argument('--token', default='standard', choices=list(tokenizers), help='Text tokenizer')
+    parser.add_argument('--filter', default=['lowercase'], nargs='+', help='Text filter: lowercase, '
+                        'asciifolding, stop, english_stop, length_filter, porter_stem, stemmer, snowball')
+    parser.add_argument('--query', default=None, nargs=argparse.REMAINDER, help='List of words to search')
+    args = parser.parse_args()
+
+    time1 = time.time()
+    local = LocalIndex.from_files(generate_files_list(args.path), Analyzer(args.token, args.filter))
+    time2 = time.time()
+    stats = local.field_statistics()
+    print(f'{stats["doc_count"]} documents, {len(local.vocabulary)} terms, {stats["sum_ttf"]} tokens '
+          f'indexed in {time2 - time1:.2f}s '
+          f'({sum(len(p) + len(f) for p, f in zip(local.postings, local.freqs)) / 2 ** 20:.2f} MB of postings)')
+
+    if args.query is not None:
+        time1 = time.time()
+        total, hits = local.search(args.query, args.nhits)
+        time2 = time.time()
+        for id, score, path in hits:
+            print(f'ID= {id} SCORE={score}')
+            print(f'PATH= {path}')
+            print('-----------------------------------------------------------------')
+        print(f'{total} Documents ({(time2 - time1) * 1000:.1f}ms)')
@@ -0,0 +1,411 @@
+"""
+.. module:: PostingsFile
+
+PostingsFile
+******
+
+:Description: PostingsFile
+
+    On disk inverted index of the files under a directory, opened with a memory map so it is ready in
+    milliseconds and only the pages used are read
+
+    The file has a header with the offset and size of every section followed by the sections, aligned to 8 bytes:
+
+        meta                JSON with the analyzer (tokenizer and filters)
+        terms               UTF-8 terms in byte order, term_offsets (uint64, nterms + 1)
+        df, ttf             document frequency and total term frequency of every term (int64)
+        postings, freqs     varints of the gaps between the documents of every term and of the term
+                            frequencies, postings_offsets and freqs_offsets (uint64, nterms + 1)
+        doc_terms, doc_freqs  varints of the gaps between the term numbers of every document and of
+                            their frequencies, doc_terms_offsets and doc_freqs_offsets (uint64, ndocs + 1)
+        lengths             tokens of every document (int64)
+        paths               UTF-8 paths, paths_offsets (uint64, ndocs + 1)
+
+    Every section is a numpy view of the memory map, the postings of a term or the vector of a document
+    are slices of these views (no copy until they are decoded)
+
+    The file is built in segments of --segment documents: every segment is indexed in memory (LocalIndex),
+    written as a postings file and then all the segments are merged term by term into the final file (the
+    sections are streamed through temporary files), so the memory used depends on the size of a segment
+    and the vocabulary, not on the size of the collection
+
+    A PostingsFile can be used as a LocalIndex (LocalIndex.py) in a LocalClient, the scripts read it with --postings:
+
+        python PostingsFile.py --path novels --output novels.postings
+        python CountWords.py --index novels --postings novels.postings
+        python TFIDFViewer.py --index novels --postings novels.postings --files novels/a.txt novels/b.txt
+
+:Authors:
+    bejar
+
+:Version:
+
+:Date:
+"""
+
+import argparse
+import heapq
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from Analyzer import Analyzer, tokenizers
+from ReadFiles import generate_files_list
+from LocalIndex import LocalIndex, LocalClient, bm25_search, varint, encode_varints, decode_varints
+
+__author__ = 'bejar'
+
+MAGIC = b'POSTING1'
+
+SECTIONS = [('meta', np.uint8), ('terms', np.uint8), ('term_offsets', np.uint64), ('df', np.int64),
+            ('ttf', np.int64), ('postings', np.uint8), ('postings_offsets', np.uint64), ('freqs', np.uint8),
+            ('freqs_offsets', np.uint64), ('doc_terms', np.uint8), ('doc_terms_offsets', np.uint64),
+            ('doc_freqs', np.uint8), ('doc_freqs_offsets', np.uint64), ('lengths', np.int64),
+            ('paths', np.uint8), ('paths_offsets', np.uint64)]
+
+
+def concatenate(blobs):
+    """
+    Concatenates a list of byte strings, returns the bytes and the offsets of every one (uint64, len + 1)
+    """
+    offsets = np.zeros(len(blobs) + 1, dtype=np.uint64)
+    offsets[1:] = np.cumsum([len(b) for b in blobs])
+    return b''.join(blobs), offsets
+
+
+def read_varint(buf):
+    """
+    First varint of a buffer, returns its value and its size in bytes
+    """
+    n = 0
+    for i, byte in enumerate(bytes(buf[:10])):
+        n |= (byte & 0x7f) << (7 * i)
+        if byte < 0x80:
+            return n, i + 1
+    raise NameError('Invalid varint')
+
+
+class Section:
+    """
+    Section of a postings file written to a temporary file while the file is merged
+    """
+
+    def __init__(self, dtype, tmpdir=None):
+        self.dtype = dtype
+        self.file = tempfile.TemporaryFile(dir=tmpdir)
+        self.size = 0  # number of elements written
+        self.pending = []  # values appended one by one, written in blocks
+
+    def write(self, data):
+        if self.pending:
+            self.flush()
+        if isinstance(data, (bytes, bytearray)):
+            self.file.write(data)
+        else:
+            data = np.ascontiguousarray(data, dtype=self.dtype)
+            self.file.write(data.tobytes())
+        self.size += len(data)
+
+    def append(self, value):
+        self.pending.append(value)
+        self.size += 1
+        if len(self.pending) == 65536:
+            self.flush()
+
+    def flush(self):
+        self.file.write(np.array(self.pending, dtype=self.dtype).tobytes())
+        self.pending = []
+
+
+def write_sections(path, data):
+    """
+    Writes the header and the sections of a postings file, every section is bytes, an array or a Section
+    """
+    header = np.zeros((len(SECTIONS), 2), dtype=np.uint64)  # offset and size in bytes of every section
+    with open(path, 'wb') as out:
+        out.write(MAGIC + header.tobytes())
+        for i, (name, dtype) in enumerate(SECTIONS):
+            section = data[name]
+            out.write(b'\0' * (-out.tell() % 8))
+            offset = out.tell()
+            if isinstance(section, Section):
+                if section.pending:
+                    section.flush()
+                section.file.seek(0)
+                shutil.copyfileobj(section.file, out)
+            else:
+                section = section if isinstance(section, bytes) else np.ascontiguousarray(section, dtype=dtype).tobytes()
+                out.write(section)
+            header[i] = offset, out.tell() - offset
+        out.seek(len(MAGIC))
+        out.write(header.tobytes())
+
+
+def write_postings(local, path):
+    """
+    Writes a LocalIndex as a postings file, the terms are renumbered in byte order
+    """
+    encoded = [t.encode('utf-8') for t in local.vocabulary]
+    order = sorted(range(len(encoded)), key=encoded.__getitem__)
+    renumber = np.empty(len(order), dtype=np.int64)
+    renumber[order] = np.arange(len(order))
+
+    terms, term_offsets = concatenate([encoded[i] for i in order])
+    postings, postings_offsets = concatenate([bytes(local.postings[i]) for i in order])
+    freqs, freqs_offsets = concatenate([bytes(local.freqs[i]) for i in order])
+
+    doc_terms = []
+    doc_freqs = []
+    for tids, tfs in local.vectors:
+        tids = renumber[np.asarray(tids, dtype=np.int64)]
+        tfs = np.asarray(tfs, dtype=np.int64)
+        sort = np.argsort(tids)
+        doc_terms.append(encode_varints(np.diff(tids[sort], prepend=0)))
+        doc_freqs.append(encode_varints(tfs[sort]))
+    doc_terms, doc_terms_offsets = concatenate(doc_terms)
+    doc_freqs, doc_freqs_offsets = concatenate(doc_freqs)
+    paths, paths_offsets = concatenate([p.encode('utf-8') for p in local.paths])
+
+    meta = json.dumps({'token': local.analyzer.token, 'filters': local.analyzer.filters}).encode('utf-8')
+    data = {'meta': meta, 'terms': terms, 'term_offsets': term_offsets,
+            'df': np.asarray(local.df, dtype=np.int64)[order], 'ttf': np.asarray(local.ttf, dtype=np.int64)[order],
+            'postings': postings, 'postings_offsets': postings_offsets,
+            'freqs': freqs, 'freqs_offsets': freqs_offsets,
+            'doc_terms': doc_terms, 'doc_terms_offsets': doc_terms_offsets,
+            'doc_freqs': doc_freqs, 'doc_freqs_offsets': doc_freqs_offsets,
+            'lengths': np.asarray(local.lengths, dtype=np.int64), 'paths': paths, 'paths_offsets': paths_offsets}
+    write_sections(path, data)
+
+
+def merge_postings(segments, path, tmpdir=None):
+    """
+    Merges postings files of consecutive sets of documents (same analyzer) into one postings file
+
+    The term dictionaries are merged with a heap, the postings of a term are the postings of the segments
+    one after another (only the first gap of every segment changes) and the vectors of the documents are
+    renumbered with the new term numbers. Only the new number of every term of every segment is kept
+    in memory, the sections are written to temporary files in tmpdir
+    """
+    parts = [PostingsFile(segment) for segment in segments]
+    out = {name: Section(dtype, tmpdir) for name, dtype in SECTIONS if name != 'meta'}
+    for name in out:
+        if name.endswith('_offsets'):
+            out[name].append(0)
+    bases = [0] + np.cumsum([part.doc_count() for part in parts]).tolist()
+    renumber = [np.empty(part.term_count(), dtype=np.int64) for part in parts]
+    # last document of the postings of every term of every segment (every term has df gaps)
+    lasts = []
+    for part in parts:
+        gaps = decode_varints(part.postings)
+        starts = np.cumsum(part.df) - part.df
+        lasts.append(np.add.reduceat(gaps, starts).tolist() if len(gaps) else [])
+
+    # terms in byte order, the same term of several segments is taken in the order of the segments
+    heap = [(part.term_bytes(0), s, 0) for s, part in enumerate(parts) if part.term_count()]
+    heapq.heapify(heap)
+    nterms = 0
+    while heap:
+        term = heap[0][0]
+        df = ttf = 0
+        last = 0  # last document of the postings of the term written
+        while heap and heap[0][0] == term:
+            _, s, tid = heapq.heappop(heap)
+            part = parts[s]
+            renumber[s][tid] = nterms
+            df += int(part.df[tid])
+            ttf += int(part.ttf[tid])
+            postings = part.postings[part.postings_offsets[tid]:part.postings_offsets[tid + 1]]
+            first, size = read_varint(postings)
+            out['postings'].write(varint(bases[s] + first - last))
+            out['postings'].write(postings[size:])
+            out['freqs'].write(part.freqs[part.freqs_offsets[tid]:part.freqs_offsets[tid + 1]])
+            last = bases[s] + lasts[s][tid]
+            if tid + 1 < part.term_count():
+                heapq.heappush(heap, (part.term_bytes(tid + 1), s, tid + 1))
+        out['terms'].write(term)
+        out['term_offsets'].append(out['terms'].size)
+        out['postings_offsets'].append(out['postings'].size)
+        out['freqs_offsets'].append(out['freqs'].size)
+        out['df'].append(df)
+        out['ttf'].append(ttf)
+        nterms += 1
+
+    # documents, the new term numbers keep the byte order so the vectors are still sorted
+    for s, part in enumerate(parts):
+        for doc in range(part.doc_count()):
+            tids, _ = part.document(doc)
+            out['doc_terms'].write(encode_varints(np.diff(renumber[s][tids], prepend=0)))
+            out['doc_terms_offsets'].append(out['doc_terms'].size)
+        for name in ('doc_freqs', 'paths'):
+            size = out[name].size
+            out[name].write(getattr(part, name))
+            out[f'{name}_offsets'].write(getattr(part, f'{name}_offsets')[1:] + np.uint64(size))
+        out['lengths'].write(part.lengths)
+
+    out['meta'] = bytes(parts[0].meta)
+    write_sections(path, out)
+
+
+def build_postings(lfiles, analyzer, path, segment_size=10000):
+    """
+    Indexes a list of files in segments of segment_size documents and writes them as a postings file
+    (merging the segments if there are more than one)
+
+    :return: number of segments
+    """
+    if len(lfiles) <= segment_size:
+        write_postings(LocalIndex.from_files(lfiles, analyzer), path)
+        return 1
+    # the segments are written next to the postings file (usually there is more room than in /tmp)
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path))) as tmpdir:
+        segments = []
+        for start in range(0, len(lfiles), segment_size):
+            segments.append(os.path.join(tmpdir, f'segment{len(segments)}'))
+            write_postings(LocalIndex.from_files(lfiles[start:start + segment_size], analyzer), segments[-1])
+        merge_postings(segments, path, tmpdir)
+    return len(segments)
+
+
+class PostingsFile:
+    """
+    Memory mapped postings file with the methods of LocalIndex used by LocalClient and bm25_search
+    """
+
+    def __init__(self, path):
+        self.buf = np.memmap(path, dtype=np.uint8, mode='r')
+        if bytes(self.buf[:len(MAGIC)]) != MAGIC:
+            raise NameError(f'{path} is not a postings file')
+        data = self.buf.view(np.ndarray)  # plain views of the map, slicing a memmap is slower
+        header = data[len(MAGIC):len(MAGIC) + 16 * len(SECTIONS)].view(np.uint64).reshape(-1, 2)
+        for (name, dtype), (offset, size) in zip(SECTIONS, header):
+            setattr(self, name, data[int(offset):int(offset + size)].view(dtype))
+        meta = json.loads(bytes(self.meta))
+        self.analyzer = Analyzer(meta['token'], meta['filters'])
+        self._by_path = None
+        self._vocabulary = None
+
+    def doc_count(self):
+        return len(self.lengths)
+
+    def doc_lengths(self):
+        return self.lengths
+
+    def term_count(self):
+        return len(self.df)
+
+    def term_bytes(self, tid):
+        return bytes(self.terms[self.term_offsets[tid]:self.term_offsets[tid + 1]])
+
+    def term(self, tid):
+        return self.term_bytes(tid).decode('utf-8')
+
+    def path(self, doc):
+        return bytes(self.paths[self.paths_offsets[doc]:self.paths_offsets[doc + 1]]).decode('utf-8')
+
+    @property
+    def vocabulary(self):
+        """
+        List of all the terms (term number -> term), decoded the first time it is used
+        """
+        if self._vocabulary is None:
+            self._vocabulary = [self.term(tid) for tid in range(self.term_count())]
+        return self._vocabulary
+
+    @property
+    def by_path(self):
+        if self._by_path is None:
+            self._by_path = {self.path(doc): doc for doc in range(self.doc_count())}
+        return self._by_path
+
+    def lookup(self, term):
+        """
+        Term number of a term (binary search in the term dictionary), None if it is not in the index
+        """
+        key = term.encode('utf-8')
+        lo, hi = 0, self.term_count()
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.term_bytes(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.term_count() and self.term(lo) == term:
+            return lo
+        return None
+
+    def documents(self, term):
+        """
+        Numbers of the documents that contain a term and the frequencies of the term in them (int64 arrays)
+        """
+        tid = self.lookup(term)
+        if tid is None:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        postings = self.postings[self.postings_offsets[tid]:self.postings_offsets[tid + 1]]
+        freqs = self.freqs[self.freqs_offsets[tid]:self.freqs_offsets[tid + 1]]
+        return np.cumsum(decode_varints(postings)), decode_varints(freqs)
+
+    def document(self, doc):
+        """
+        Term numbers of a document (in byte order of the terms) and their frequencies (int64 arrays)
+        """
+        tids = self.doc_terms[self.doc_terms_offsets[doc]:self.doc_terms_offsets[doc + 1]]
+        tfs = self.doc_freqs[self.doc_freqs_offsets[doc]:self.doc_freqs_offsets[doc + 1]]
+        return np.cumsum(decode_varints(tids)), decode_varints(tfs)
+
+    def field_statistics(self):
+        return {'sum_doc_freq': int(self.df.sum()), 'doc_count': self.doc_count(), 'sum_ttf': int(self.ttf.sum())}
+
+    def term_vector(self, id, term_statistics=True, field_statistics=True):
+        """
+        termvectors answer of a document (only the 'text' field)
+        """
+        doc = int(id) if str(id).isdigit() else -1
+        if not 0 <= doc < self.doc_count():
+            return {'_id': id, 'found': False}
+        tids, tfs = self.document(doc)
+        terms = {}
+        for tid, f in zip(tids.tolist(), tfs.tolist()):
+            entry = {'term_freq': f}
+            if term_statistics:
+                entry['doc_freq'] = int(self.df[tid])
+                entry['ttf'] = int(self.ttf[tid])
+            terms[self.term(tid)] = entry
+        text = {'terms': terms}
+        if field_statistics:
+            text['field_statistics'] = self.field_statistics()
+        return {'_id': id, 'found': True, 'term_vectors': {'text': text} if terms else {}}
+
+    def search(self, query, nhits=10):
+        return bm25_search(self, query, nhits)
+
+
+def open_postings(index, path):
+    """
+    LocalClient with a postings file as the index
+    """
+    return LocalClient({index: PostingsFile(path)})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', required=True, default=None, help='Path to the files')
+    parser.add_argument('--output', required=True, default=None, help='Postings file')
+    parser.add_argument('--segment', default=10000, type=int, help='Documents indexed in memory per segment')
+    parser.add_argument('--token', default='standard', choices=list(tokenizers), help='Text tokenizer')
+    parser.add_argument('--filter', default=['lowercase'], nargs=argparse.REMAINDER, help='Text filter: lowercase, '
+                        'asciifolding, stop, english_stop, length_filter, porter_stem, stemmer, snowball')
+    args = parser.parse_args()
+
+    time1 = time.time()
+    nsegments = build_postings(generate_files_list(args.path), Analyzer(args.token, args.filter), args.output,
+                               args.segment)
+    time2 = time.time()
+    postings = PostingsFile(args.output)
+    time3 = time.time()
+    print(f'{postings.doc_count()} documents, {postings.term_count()} terms indexed and written in '
+          f'{time2 - time1:.2f}s ({nsegments} segments, {len(postings.buf) / 2 ** 20:.2f} MB), '
+          f'opened in {(time3 - time2) * 1000:.2f}ms')
@@ -0,0 +1,96 @@
+"""
+.. module:: ReadFiles
+
+ReadFiles
+******
+
+:Description: ReadFiles
+
+    Lists and reads the files under a directory as the indexing scripts do (one document per file, decoded
+    as iso-8859-1), shared by the indexing scripts and the offline scripts that do not use Elasticsearch
+
+    Only index_files() needs the Elasticsearch client, its helpers are imported when it is called
+
+:Authors:
+    bejar
+
+:Version:
+
+:Date:
+"""
+
+import codecs
+import os
+import time
+
+__author__ = 'bejar'
+
+
+def generate_files_list(path):
+    """
+    Generates a list of all the files inside a path
+    :param path:
+    :return:
+    """
+    if path[-1] == '/':
+        path = path[:-1]
+
+    lfiles = []
+
+    for lf in os.walk(path):
+        if lf[2]:
+            for f in lf[2]:
+                lfiles.append(lf[0] + '/' + f)
+    return lfiles
+
+
+def generate_actions(lfiles, index, stats):
+    """
+    Generates lazily the index operation of every file, reading each file with a single read.
+    The characters read are added up in stats['bytes']
+    :param lfiles:
+    :param index:
+    :param stats:
+    :return:
+    """
+    for f in lfiles:
+        with codecs.open(f, "r", encoding='iso-8859-1') as ftxt:
+            text = ftxt.read()
+        stats['bytes'] += len(text)
+        # Insert operation for a document with fields' path' and 'text'
+        yield {'_op_type': 'index', '_index': index, 'path': f, 'text': text}
+
+
+def index_files(client, lfiles, index, chunk_size=500, max_chunk_bytes=100 * 1024 * 1024, threads=1, report=1000):
+    """
+    Indexes the files streaming the operations to streaming_bulk (or parallel_bulk with threads > 1),
+    only the documents of the chunks being sent are in memory. Prints the throughput every report documents
+    :return: number of documents indexed and number of errors
+    """
+    from elasticsearch.helpers import streaming_bulk, parallel_bulk
+
+    stats = {'bytes': 0}
+    actions = generate_actions(lfiles, index, stats)
+    if threads > 1:
+        results = parallel_bulk(client, actions, thread_count=threads, chunk_size=chunk_size,
+                                max_chunk_bytes=max_chunk_bytes, raise_on_error=False)
+    else:
+        results = streaming_bulk(client, actions, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes,
+                                 raise_on_error=False)
+
+    def throughput():
+        elapsed = max(time.time() - start, 1e-9)
+        print(f'{ndocs} documents, {errors} errors, {ndocs / elapsed:.1f} docs/s, '
+              f'{stats["bytes"] / elapsed / 2 ** 20:.2f} MB/s')
+
+    start = time.time()
+    ndocs = 0
+    errors = 0
+    for ok, _ in results:
+        ndocs += 1
+        if not ok:
+            errors += 1
+        if ndocs % report == 0:
+            throughput()
+    throughput()
+    return ndocs, errors
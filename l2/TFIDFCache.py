@@ -0,0 +1,87 @@
+"""
+.. module:: TFIDFCache
+
+TFIDFCache
+******
+
+:Description: TFIDFCache
+
+    Bounded LRU cache (in memory) of the normalized TF-IDF vectors of documents, keyed by
+    (index, _id, generation), to share the vectors among the rounds and the queries of a session
+
+    The generation of an index is its uuid and its number of documents, so the vectors are computed again
+    when the index is rebuilt or documents are added or removed (the idf changes). Only the vectors that
+    are not in the cache are fetched, with one mtermvectors request
+
+        cache = TFIDFCache(client, maxsize=10000)
+        vectors = cache.tfidf(index, ids)
+        print(cache.hits, cache.misses)
+
+:Authors:
+    bejar
+
+:Version:
+
+:Date:
+"""
+
+from collections import OrderedDict
+
+from TFIDFViewer import TFIDFIndex, doc_count
+
+__author__ = 'bejar'
+
+
+class TFIDFCache:
+    def __init__(self, client, maxsize=10000):
+        self.client = client
+        self.maxsize = maxsize
+        self.vectors = OrderedDict()  # (index, id, generation) -> list of pairs (term, weight), oldest first
+        self.hits = 0
+        self.misses = 0
+
+    def generation(self, index):
+        """
+        Current generation of an index: (uuid, number of documents)
+        """
+        settings = self.client.indices.get_settings(index=index)
+        uuid = next(iter(settings.values()))['settings']['index']['uuid']
+        return uuid, doc_count(self.client, index)
+
+    def tfidf(self, index, ids, generation=None):
+        """
+        Returns the list of (id, normalized TF-IDF vector) of the documents in ids that have text, in the same order
+
+        :param index:
+        :param ids:
+        :param generation: generation of the index, asked to the index if None
+        :return:
+        """
+        if generation is None:
+            generation = self.generation(index)
+        found = {}
+        missing = []
+        for id in ids:
+            key = (index, id, generation)
+            if key in self.vectors:
+                self.vectors.move_to_end(key)
+                found[id] = self.vectors[key]
+                self.hits += 1
+            else:
+                missing.append(id)
+                self.misses += 1
+
+        if missing:
+            tfidf = TFIDFIndex(self.client, index, chunk_size=len(missing))
+            tfidf._doc_count = generation[1]  # the idf of the generation of the key
+            for id, tw in tfidf.tfidf(missing):
+                found[id] = self.vectors[(index, id, generation)] = tw
+            while len(self.vectors) > self.maxsize:
+                self.vectors.popitem(last=False)
+
+        return [(id, found[id]) for id in ids if id in found]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return f'{self.hits} hits, {self.misses} misses ({self.hits / max(total, 1):.1%} hit rate), ' \
+               f'{len(self.vectors)} vectors cached'
@@ -8,6 +8,14 @@ TFIDFViewer
 
     Receives two paths of files to compare (the paths have to be the ones used when indexing the files)
 
+    With --all the TF-IDF vectors of all the documents of the index are computed as a stream, fetching the
+    term vectors with mtermvectors in chunks of --chunk documents
+
+    With --topk K the K most similar documents of every document of the index are written to --output,
+    the similarities are computed as blocked sparse matrix products of the document-term matrix
+
+    With --postings file the term vectors are read from a postings file (PostingsFile.py) instead of the index
+
 :Authors:
     bejar
 
@@ -19,12 +27,20 @@ TFIDFViewer
 from elasticsearch import Elasticsearch
 from elasticsearch.exceptions import NotFoundError
 from elasticsearch.client import CatClient
+from elasticsearch.helpers import scan
 from elasticsearch_dsl import Search
 from elasticsearch_dsl.query import Q
 
+from TermVectorCache import TermVectorCache
+from LocalIndex import LocalClient
+from PostingsFile import open_postings
+import LocalIndex as local
+
+from array import array
 import argparse
 
 import numpy as np
+from scipy.sparse import csr_matrix
 
 __author__ = 'bejar'
 
@@ -35,6 +51,8 @@ def search_file_by_path(client, index, path):
     :param path:
     :return:
     """
+    if isinstance(client, LocalClient):
+        return local.search_file_by_path(client, index, path)
     s = Search(using=client, index=index)
     q = Q('match', path=path)  # exact search in the path field
     s = s.query(q)
@@ -60,11 +78,21 @@ def document_term_vector(client, index, id):
     """
     termvector = client.termvectors(index=index, id=id, fields=['text'],
                                     positions=False, term_statistics=True)
+    return parse_term_vector(termvector)
+
 
+def parse_term_vector(termvector):
+    """
+    Converts a termvectors answer (or a doc of a mtermvectors answer) into the two sorted lists
+    of pairs returned by document_term_vector
+
+    :param termvector:
+    :return:
+    """
     file_td = {}
     file_df = {}
 
-    if 'text' in termvector['term_vectors']:
+    if 'text' in termvector.get('term_vectors', {}):
         for t in termvector['term_vectors']['text']['terms']:
             file_td[t] = termvector['term_vectors']['text']['terms'][t]['term_freq']
             file_df[t] = termvector['term_vectors']['text']['terms'][t]['doc_freq']
@@ -83,9 +111,19 @@ def toTFIDF(client, index, file_id):
     # that contain the term
     file_tv, file_df = document_term_vector(client, index, file_id)
 
-    max_freq = max([f for _, f in file_tv])
+    return tfidf_weights(file_tv, file_df, doc_count(client, index))
+
 
-    dcount = doc_count(client, index)
+def tfidf_weights(file_tv, file_df, dcount):
+    """
+    Returns the normalized term weights of a document from its term vector and document frequencies
+
+    :param file_tv:
+    :param file_df:
+    :param dcount:
+    :return:
+    """
+    max_freq = max([f for _, f in file_tv])
 
     tfidfw = []
     for (t, w),(_, df) in zip(file_tv, file_df):
@@ -161,6 +199,58 @@ def cosine_similarity(tw1, tw2):
     return cosine_sim
 
 
+def tfidf_matrix(vectors):
+    """
+    Builds the CSR document-term matrix of a stream of normalized weight vectors (one row per vector), the
+    vectors are consumed as they come and only the arrays of the matrix are kept
+
+    :param vectors: iterable of pairs (id, list of pairs (term, weight))
+    :return: the matrix, the list of ids (row names) and the list of terms (column names)
+    """
+    terms = {}
+    ids = []
+    indptr = array('q', [0])
+    indices = array('q')
+    data = array('d')
+    for id, tw in vectors:
+        ids.append(id)
+        for t, w in tw:
+            indices.append(terms.setdefault(t, len(terms)))
+            data.append(w)
+        indptr.append(len(indices))
+    X = csr_matrix((np.frombuffer(data, dtype=np.float64), np.frombuffer(indices, dtype=np.int64),
+                    np.frombuffer(indptr, dtype=np.int64)), shape=(len(indptr) - 1, len(terms)))
+    return X, ids, list(terms)
+
+
+def top_k_similar(X, k, block_size=256):
+    """
+    Generates, for every row of X, the list of pairs (row, cosine similarity) of the k most similar other rows,
+    from most to least similar. The rows must be normalized. Similarities are computed block_size rows
+    at a time as X[block] @ X.T, so only a block_size x ndocs block is in memory
+
+    :param X: CSR document-term matrix
+    :param k:
+    :param block_size:
+    :return:
+    """
+    ndocs = X.shape[0]
+    XT = X.T.tocsc()
+    k = min(k, ndocs - 1)
+    if k <= 0:
+        for _ in range(ndocs):
+            yield []
+        return
+    for start in range(0, ndocs, block_size):
+        end = min(start + block_size, ndocs)
+        sims = (X[start:end] @ XT).toarray()
+        sims[np.arange(end - start), np.arange(start, end)] = -np.inf  # a document is not its own neighbor
+        best = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        for row, cols in enumerate(best):
+            cols = cols[np.argsort(-sims[row, cols], kind='stable')]
+            yield [(c, sims[row, c]) for c in cols]
+
+
 def doc_count(client, index):
     """
     Returns the number of documents in an index
@@ -169,45 +259,168 @@ def doc_count(client, index):
     :param index:
     :return:
     """
+    if isinstance(client, LocalClient):
+        return local.doc_count(client, index)
     return int(CatClient(client).count(index=[index], format='json')[0]['count'])
 
 
+class TFIDFIndex:
+    """
+    Batched TF-IDF over an index: term vectors are fetched with mtermvectors in chunks of chunk_size documents,
+    the document count is fetched once and the document frequency of every term seen is kept in df
+    """
+
+    def __init__(self, client, index, chunk_size=500):
+        self.client = client
+        self.index = index
+        self.chunk_size = chunk_size
+        self._doc_count = None
+        self.df = {}
+
+    def doc_count(self):
+        if self._doc_count is None:
+            # count API instead of cat, also answered by LocalIndex.LocalClient
+            self._doc_count = self.client.count(index=self.index)['count']
+        return self._doc_count
+
+    def idf(self, term):
+        """
+        Inverse document frequency of a term already seen in a term vector
+        """
+        return np.log2(self.doc_count() / self.df[term])
+
+    def all_ids(self):
+        """
+        Generates the (id, path) of all the documents of the index
+        """
+        if isinstance(self.client, LocalClient):
+            yield from self.client.all_ids(self.index)
+            return
+        for s in scan(self.client, index=self.index, query={"query": {"match_all": {}}}, _source=['path']):
+            yield s['_id'], s['_source']['path']
+
+    def term_vectors(self, ids):
+        """
+        Generates (id, file_tv, file_df) for the documents in ids, with one mtermvectors request per chunk.
+        Documents without text or not found are skipped
+
+        :param ids: iterable of document ids
+        :return:
+        """
+        chunk = []
+        for id in ids:
+            chunk.append(id)
+            if len(chunk) == self.chunk_size:
+                yield from self._fetch(chunk)
+                chunk = []
+        if chunk:
+            yield from self._fetch(chunk)
+
+    def _fetch(self, ids):
+        response = self.client.mtermvectors(index=self.index, body={'ids': ids}, fields=['text'],
+                                            positions=False, offsets=False, term_statistics=True)
+        for doc in response['docs']:
+            if not doc.get('found', False):
+                continue
+            file_tv, file_df = parse_term_vector(doc)
+            if not file_tv:
+                continue
+            self.df.update(file_df)
+            yield doc['_id'], file_tv, file_df
+
+    def tfidf(self, ids):
+        """
+        Generates (id, normalized TF-IDF vector) for the documents in ids, same vectors as toTFIDF
+
+        :param ids: iterable of document ids
+        :return:
+        """
+        dcount = self.doc_count()
+        for id, file_tv, file_df in self.term_vectors(ids):
+            yield id, tfidf_weights(file_tv, file_df, dcount)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--index', default=None, required=True, help='Index to search')
-    parser.add_argument('--files', default=None, required=True, nargs=2, help='Paths of the files to compare')
+    parser.add_argument('--files', default=None, nargs=2, help='Paths of the files to compare')
+    parser.add_argument('--all', default=False, action='store_true', help='Compute the TFIDF vectors of all the documents')
+    parser.add_argument('--chunk', default=500, type=int, help='Documents per mtermvectors request with --all')
     parser.add_argument('--print', default=False, action='store_true', help='Print TFIDF vectors')
+    parser.add_argument('--topk', default=None, type=int, help='Write the K most similar documents of every document')
+    parser.add_argument('--block', default=256, type=int, help='Documents per block of the similarity products')
+    parser.add_argument('--output', default='similarities.txt', help='Output file of --topk')
+    parser.add_argument('--cache', default=None, help='Local term vector cache file (SQLite)')
+    parser.add_argument('--postings', default=None, help='Postings file (PostingsFile.py) to read instead of the index')
 
     args = parser.parse_args()
 
+    if not args.all and args.topk is None and args.files is None:
+        parser.error('--files, --all or --topk is required')
 
     index = args.index
 
-    file1 = args.files[0]
-    file2 = args.files[1]
-
     client = Elasticsearch(timeout=1000)
+    if args.cache:
+        client = TermVectorCache(client, args.cache)
+    if args.postings:
+        client = open_postings(index, args.postings)
 
     try:
 
-        # Get the files ids
-        file1_id = search_file_by_path(client, index, file1)
-        file2_id = search_file_by_path(client, index, file2)
+        if args.topk is not None:
+            # All pairs similarities, the vectors of the whole index are kept as a sparse matrix
+            tfidf_index = TFIDFIndex(client, index, chunk_size=args.chunk)
+            paths = dict(tfidf_index.all_ids())
+            X, ids, _ = tfidf_matrix(tfidf_index.tfidf(paths))
+            print(f'Document-term matrix: {X.shape[0]} Documents, {X.shape[1]} Terms, {X.nnz} non zeros')
+
+            with open(args.output, 'w') as out:
+                for doc, neighbors in enumerate(top_k_similar(X, args.topk, args.block)):
+                    for rank, (other, sim) in enumerate(neighbors, 1):
+                        out.write(f'{paths[ids[doc]]}\t{rank}\t{paths[ids[other]]}\t{sim:3.5f}\n')
+            print(f'Top {args.topk} similar documents written to {args.output}')
+
+        elif args.all:
+            # Stream the TF-IDF vectors of the whole index
+            tfidf_index = TFIDFIndex(client, index, chunk_size=args.chunk)
+            paths = {}
+
+            def index_ids():
+                for id, path in tfidf_index.all_ids():
+                    paths[id] = path
+                    yield id
+
+            ndocs = 0
+            for id, tw in tfidf_index.tfidf(index_ids()):
+                ndocs += 1
+                print(f'{paths.pop(id)}: {len(tw)} terms')
+                if args.print:
+                    print_term_weigth_vector(tw)
+                    print('---------------------')
+            print(f'{ndocs} Documents, {len(tfidf_index.df)} Terms')
 
-        # Compute the TF-IDF vectors
-        file1_tw = toTFIDF(client, index, file1_id)
-        file2_tw = toTFIDF(client, index, file2_id)
+        else:
+            file1 = args.files[0]
+            file2 = args.files[1]
+
+            # Get the files ids
+            file1_id = search_file_by_path(client, index, file1)
+            file2_id = search_file_by_path(client, index, file2)
 
-        if args.print:
-            print(f'TFIDF FILE {file1}')
-            print_term_weigth_vector(file1_tw)
-            print ('---------------------')
-            print(f'TFIDF FILE {file2}')
-            print_term_weigth_vector(file2_tw)
-            print ('---------------------')
+            # Compute the TF-IDF vectors
+            file1_tw = toTFIDF(client, index, file1_id)
+            file2_tw = toTFIDF(client, index, file2_id)
 
-        print(f"Similarity = {cosine_similarity(file1_tw, file2_tw):3.5f}")
+            if args.print:
+                print(f'TFIDF FILE {file1}')
+                print_term_weigth_vector(file1_tw)
+                print ('---------------------')
+                print(f'TFIDF FILE {file2}')
+                print_term_weigth_vector(file2_tw)
+                print ('---------------------')
+
+            print(f"Similarity = {cosine_similarity(file1_tw, file2_tw):3.5f}")
 
     except NotFoundError:
         print(f'Index {index} does not exists')
-
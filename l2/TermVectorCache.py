@@ -0,0 +1,154 @@
+"""
+.. module:: TermVectorCache
+
+TermVectorCache
+******
+
+:Description: TermVectorCache
+
+    Local on disk (SQLite) cache of the term vectors of the 'text' field, keyed by (index, _id)
+
+    TermVectorCache wraps an Elasticsearch client and can be used everywhere the client is used:
+    termvectors and mtermvectors answers come from the cache when possible (always stored with
+    term statistics), everything else is sent to the wrapped client
+
+        client = TermVectorCache(Elasticsearch(timeout=1000), 'termvectors.db')
+
+    The cached vectors of an index are dropped when the index is rebuilt (its uuid changes) or written
+    (the max_seq_no of a primary shard changes, any document indexed, updated in place or deleted), checked
+    the first time the index is used in a session, so the cache does not depend on the indexing scripts.
+    IndexFilesPreprocess.py --cache also drops them right away to free the space
+
+:Authors:
+    bejar
+
+:Version:
+
+:Date:
+"""
+
+import json
+import sqlite3
+import threading
+import zlib
+
+__author__ = 'bejar'
+
+
+class TermVectorCache:
+    def __init__(self, client, path):
+        self.client = client
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.checked = set()  # indices whose generation has been checked in this session
+        self.hits = 0
+        self.misses = 0
+        with self.db:
+            columns = [row[1] for row in self.db.execute('PRAGMA table_info(generations)')]
+            if columns and 'max_seq_no' not in columns:  # cache file of a version that only stored the uuid
+                self.db.execute('DROP TABLE generations')
+            self.db.execute('CREATE TABLE IF NOT EXISTS generations (idx TEXT PRIMARY KEY, uuid TEXT, max_seq_no TEXT)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS termvectors '
+                            '(idx TEXT, id TEXT, data BLOB, PRIMARY KEY (idx, id))')
+
+    def __getattr__(self, name):
+        # everything that is not cached goes to the wrapped client
+        return getattr(self.client, name)
+
+    def invalidate(self, index):
+        """
+        Drops the cached term vectors of an index
+        """
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM termvectors WHERE idx = ?', (index,))
+            self.db.execute('DELETE FROM generations WHERE idx = ?', (index,))
+        self.checked.discard(index)
+
+    def generation(self, index):
+        """
+        Generation of an index: its uuid and the max_seq_no of every primary shard (as 'shard:seq_no,...')
+        """
+        settings = self.client.indices.get_settings(index=index)
+        uuid = next(iter(settings.values()))['settings']['index']['uuid']
+        stats = self.client.indices.stats(index=index, metric='docs', level='shards')
+        shards = next(iter(stats['indices'].values()))['shards']
+        max_seq_no = ','.join(f'{shard}:{copy["seq_no"]["max_seq_no"]}'
+                              for shard, copies in sorted(shards.items(), key=lambda s: int(s[0]))
+                              for copy in copies if copy['routing']['primary'])
+        return uuid, max_seq_no
+
+    def check_generation(self, index):
+        """
+        Drops the cached term vectors of an index if it has been rebuilt or written since they were stored
+        """
+        if index in self.checked:
+            return
+        uuid, max_seq_no = self.generation(index)
+        with self.lock:
+            row = self.db.execute('SELECT uuid, max_seq_no FROM generations WHERE idx = ?', (index,)).fetchone()
+        if row is None or row != (uuid, max_seq_no):
+            self.invalidate(index)
+            with self.lock, self.db:
+                self.db.execute('INSERT INTO generations VALUES (?, ?, ?)', (index, uuid, max_seq_no))
+        self.checked.add(index)
+
+    def get(self, index, ids):
+        """
+        Returns the dict id -> term_vectors of the ids that are in the cache
+        """
+        found = {}
+        with self.lock:
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                rows = self.db.execute(f'SELECT id, data FROM termvectors WHERE idx = ? AND id IN '
+                                       f'({",".join("?" * len(chunk))})', [index] + chunk)
+                for id, data in rows:
+                    found[id] = json.loads(zlib.decompress(data))
+        return found
+
+    def put(self, index, docs):
+        """
+        Stores the term vectors of the docs of a (m)termvectors answer
+        """
+        rows = [(index, doc['_id'], zlib.compress(json.dumps(doc.get('term_vectors', {})).encode()))
+                for doc in docs if doc.get('found', False)]
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO termvectors VALUES (?, ?, ?)', rows)
+
+    @staticmethod
+    def cacheable(fields, params):
+        return list(fields or ['text']) == ['text'] and not params.get('positions') and not params.get('offsets')
+
+    def termvectors(self, index, id=None, fields=None, **params):
+        if id is None or not self.cacheable(fields, params):  # artificial documents are not cached
+            return self.client.termvectors(index=index, id=id, fields=fields, **params)
+        self.check_generation(index)
+        found = self.get(index, [id])
+        if id in found:
+            self.hits += 1
+            return {'_index': index, '_id': id, 'found': True, 'term_vectors': found[id]}
+        self.misses += 1
+        doc = self.client.termvectors(index=index, id=id, fields=['text'], positions=False, offsets=False,
+                                      term_statistics=True)
+        self.put(index, [doc])
+        return doc
+
+    def mtermvectors(self, index, body, fields=None, **params):
+        ids = list(body.get('ids', [])) if body else []
+        if not ids or not self.cacheable(fields, params):
+            return self.client.mtermvectors(index=index, body=body, fields=fields, **params)
+        self.check_generation(index)
+        found = self.get(index, ids)
+        missing = [id for id in ids if id not in found]
+        self.hits += len(ids) - len(missing)
+        self.misses += len(missing)
+        docs = {}
+        if missing:
+            response = self.client.mtermvectors(index=index, body={'ids': missing}, fields=['text'],
+                                                positions=False, offsets=False, term_statistics=True)
+            self.put(index, response['docs'])
+            docs = {doc['_id']: doc for doc in response['docs']}
+        return {'docs': [{'_index': index, '_id': id, 'found': True, 'term_vectors': found[id]}
+                         if id in found else docs.get(id, {'_index': index, '_id': id, 'found': False})
+                         for id in ids]}
@@ -1,80 +1,124 @@
-import re
+import argparse
+import glob
+import os
+
+import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
+import pandas as pd
 from scipy.optimize import curve_fit
 
-a = 1.15 # Parametro a
+a = 1.15 # Parametro a, valor inicial del ajuste (fijo con --a)
+
+WORD = r"[a-zA-Z]*'?[a-zA-Z]*"
+ROMAN = r"M{0,3}(?:CM|CD|D?C{0,3})(?:XC|XL|L?X{0,3})(?:IX|IV|V?I{0,3})"
+NOT_ROMAN = ['MIX', 'I', 'DIV', 'DIX']
+
+def read_counts(path):
+    """
+    Lee un fichero 'count, word' (salida de CountWords.py) en un DataFrame con columnas count y word,
+    ordenado por frecuencia descendente (rank). Las lineas que no son 'count, word' se ignoran
+    """
+    with open(path, 'r') as infile:
+        lines = pd.Series(infile.read().splitlines())
+    df = lines.str.extract(r'^(\d+), (.*)$').dropna()
+    df.columns = ['count', 'word']
+    df['count'] = df['count'].astype(np.int64)
+    # se invierte como hacia el script (los ficheros ByRank van de menor a mayor frecuencia) y se ordena
+    # por frecuencia descendente, los empates quedan en el orden invertido
+    df = df.iloc[::-1]
+    return df.iloc[np.argsort(-df['count'].to_numpy(), kind='stable')].reset_index(drop=True)
+
+def filter_words(df):
+    """
+    Deja solo las palabras formadas por letras (con un apostrofe como mucho) que no son numeros romanos
+    """
+    words = df['word']
+    upper = words.str.upper()
+    roman = upper.str.fullmatch(ROMAN) & ~upper.isin(NOT_ROMAN)
+    return df[words.str.fullmatch(WORD) & ~roman].reset_index(drop=True)
 
-def is_roman_numeral(s):
-    if s.upper() not in ['MIX', 'I', 'DIV', 'DIX']:
-        pattern = '^M{0,3}(CM|CD|D?C{0,3})(XC|XL|L?X{0,3})(IX|IV|V?I{0,3})$'
-        return bool(re.match(pattern, s.upper()))
-    
 #Zipf's law formula
-def zipf_formula(x, b, c):
+def zipf_formula(x, a, b, c):
     return c/(x+b)**a
 
-def zipf_plot(ranks:list, freqs:list, fits:list, ranksLog:list, freqsLog:list, fitsLog:list, isLog:bool, b, c):
+def log_zipf_formula(x, a, b, logc):
+    return logc - a * np.log(x + b)
+
+def fit_zipf(freqs, fixed_a=None):
+    """
+    Ajusta a, b y c (o solo b y c si se fija a) sobre el logaritmo de las frecuencias, asi todos los
+    ranks pesan lo mismo en el ajuste y no solo las palabras mas frecuentes
+    """
+    freqs = np.asarray(freqs, dtype=np.float64)
+    ranks = np.arange(1, len(freqs) + 1, dtype=np.float64)
+    logf = np.log(freqs)
+    if fixed_a is None:
+        popt, _ = curve_fit(log_zipf_formula, ranks, logf, p0=(a, 1.0, logf[0]),
+                            bounds=([0, -0.99, -np.inf], [np.inf, np.inf, np.inf]))
+        fa, b, logc = popt
+    else:
+        popt, _ = curve_fit(lambda x, b, logc: log_zipf_formula(x, fixed_a, b, logc), ranks, logf,
+                            p0=(1.0, logf[0]), bounds=([-0.99, -np.inf], [np.inf, np.inf]))
+        fa = fixed_a
+        b, logc = popt
+    return fa, b, np.exp(logc)
+
+def zipf_plot(ranks, freqs, fits, isLog, a, b, c, filename=None):
     if not isLog:
-        plt.plot(ranks, freqs, 'b-', label='Frecuencias en Log')
-        plt.plot(ranks, fits,'r-',label='Zipf fit en Log')
-        plt.legend()
+        plt.plot(ranks, freqs, 'b-', label='Frecuencias')
+        plt.plot(ranks, fits,'r-',label='Zipf fit')
+        plt.xlabel('x = Rank de la palabra')
+        plt.ylabel('y = Frecuencia de la palabra')
+    else:
+        plt.plot(np.log(ranks), np.log(freqs), 'b-', label='Frecuencias en Log')
+        plt.plot(np.log(ranks), np.log(fits),'r-',label='Zipf fit en Log')
         plt.xlabel('x = Log del Rank de la palabra')
         plt.ylabel('y = Log de la Frecuencia de la palabra')
-        plt.title(f'a = {a} b = {b} c = {c}')
+    plt.legend()
+    plt.title(f'a = {a:.4f} b = {b:.4f} c = {c:.4g}')
+    if filename is None:
         plt.show()
     else:
-        plt.plot(ranksLog, freqsLog, 'b-', label='Frecuencias')
-        plt.plot(ranksLog, fitsLog,'r-',label='Zipf fit')
-        plt.legend()
-        plt.xlabel('x = Rank de la palabra')
-        plt.ylabel('y = Frecuencia de la palabra')
-        plt.title(f'a = {a} b = {b} c = {c}')
-        plt.show()
-    
-def zipf(freqs:list, freqsLog:list, isLog=True):
-    ranks = range(1, len(freqs) + 1)
-    ranksLog = np.log(ranks) # Rango de log(1) a log(wordCount)
-    popt, pcov = curve_fit(zipf_formula, ranks, freqs)
-    b = popt[0]
-    c = popt[1]
-    print(f'Zipf optimal parameters: b = {b}, c = {c}')
-    fits = []
-    fitsLog = []
-    for num in ranks:
-        fits.append(zipf_formula(num,*popt))
-        fitsLog.append(np.log(zipf_formula(num,*popt)))
+        plt.savefig(filename)
+    plt.close()
 
-    zipf_plot(ranks, freqs, fits, ranksLog, freqsLog, fitsLog, isLog, b, c)
+def zipf(freqs, isLog=True, fixed_a=None, filename=None, plot=True):
+    freqs = np.asarray(freqs, dtype=np.float64)
+    ranks = np.arange(1, len(freqs) + 1)
+    fa, b, c = fit_zipf(freqs, fixed_a)
+    fits = zipf_formula(ranks, fa, b, c)
+    if plot:
+        zipf_plot(ranks, freqs, fits, isLog, fa, b, c, filename)
+    return fa, b, c
 
-    
-if __name__ == '__main__':
-    input_text = input('Enter the input text file path: ')
+def process(input_text, output_text, fixed_a=None, plot=None):
+    """
+    Filtra un fichero de cuentas, escribe las palabras que quedan por rank y ajusta la ley de Zipf
+    """
+    df = read_counts(input_text)
+    filtered = filter_words(df)
+    with open(output_text, 'w') as outfile:
+        outfile.write(''.join(filtered['count'].astype(str) + ', ' + filtered['word'] + '\n'))
+    fa, b, c = zipf(filtered['count'].to_numpy(), fixed_a=fixed_a, filename=plot, plot=plot is not None)
+    return len(df), len(filtered), fa, b, c
 
-    freqs = []  # Lista para recolectar los números
-    freqsLog = []  # Lista para recolectar los números con log
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', nargs='*', help='Ficheros de cuentas (por defecto wordsCount*.txt)')
+    parser.add_argument('--suffix', default='_filtered', help='Sufijo de los ficheros filtrados')
+    parser.add_argument('--a', default=None, type=float, help='Valor fijo de a (por defecto se ajusta)')
+    parser.add_argument('--plot', default=False, action='store_true', help='Guarda la grafica de cada ajuste en un png')
+    args = parser.parse_args()
 
-    with open(input_text, 'r') as infile:
-        inlines = infile.readlines()  # Lee todas las líneas en una lista
-        inlines.reverse()  # Invierte la lista para recorrerla al revés
-        
-        output_text = input('Enter the output text file name: ')
-        # Cambiado 'rw' a 'w' ya que 'rw' no es un modo válido.
-        with open(output_text, 'w') as outfile:
-            for line in inlines:
-                if ',' in line:
-                    number, word = line.strip().split(', ')
-                    if re.match("^[a-zA-Z]*'?[a-zA-Z]*$", word) and not is_roman_numeral(word):
-                        outfile.write(number+', '+word + '\n')
-                        # Asumo que number es un valor entero.
-                        freqs.append(int(number))
-                        freqsLog.append(np.log(int(number)))
+    files = args.files or sorted(f for f in glob.glob('wordsCount*.txt')
+                                 if not os.path.splitext(f)[0].endswith(args.suffix))
+    matplotlib.use('Agg')  # las graficas se guardan en ficheros, sin ventanas
 
-    zipf(freqs, freqsLog)
-    
-    # Crear gráfica de los números en escala logarítmica
-    plt.plot(freqs)
-    plt.xlabel('Rank')
-    plt.ylabel('Ocurrencias')
-    plt.title('Numero de ocurrences de cada palabra')
-    plt.show()
\ No newline at end of file
+    print('Fichero\tPalabras\tFiltradas\ta\tb\tc')
+    for input_text in files:
+        stem, ext = os.path.splitext(input_text)
+        output_text = stem + args.suffix + ext
+        plot = stem + '_Zipf.png' if args.plot else None
+        nwords, nfiltered, fa, b, c = process(input_text, output_text, args.a, plot)
+        print(f'{input_text}\t{nwords}\t{nfiltered}\t{fa:.4f}\t{b:.4f}\t{c:.4g}')
@@ -15,6 +15,9 @@ IndexFiles
 
     If the index exists it is dropped and created new
 
+    With --incremental manifest.json only the files added, changed or removed since the last run are
+    sent to the index (see IncrementalIndex.py), the index is rebuilt if the analyzer is different
+
     Documentation for the analyzer configuration:
 
     https://www.elastic.co/guide/en/elasticsearch/reference/current/analysis.html
@@ -28,11 +31,17 @@ IndexFiles
 """
 
 from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk
 from elasticsearch.exceptions import NotFoundError
 import argparse
 import os
-import codecs
+import time
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'l2'))
+from ReadFiles import index_files
+from TermVectorCache import TermVectorCache
+from BulkLoad import bulk_load
+from IncrementalIndex import save_manifest, index_changes, run_incremental
 from elasticsearch_dsl import Index, analyzer, tokenizer
 
 
@@ -62,9 +71,16 @@ if __name__ == '__main__':
     parser.add_argument('--index', required=True, default=None, help='Index for the files')
     parser.add_argument('--token', default='standard', choices=['standard', 'whitespace', 'classic', 'letter'],
                         help='Text tokenizer')
+    parser.add_argument('--chunk', default=500, type=int, help='Documents per bulk request')
+    parser.add_argument('--chunkmb', default=100, type=float, help='Maximum size of a bulk request in MB')
+    parser.add_argument('--threads', default=1, type=int, help='Threads sending bulk requests (parallel_bulk)')
+    parser.add_argument('--incremental', default=None, help='Manifest file, index only the files that changed')
+    parser.add_argument('--cache', default=None, help='Term vector cache file (SQLite) to invalidate for the index')
     parser.add_argument('--filter', default=['lowercase'], nargs=argparse.REMAINDER, help='Text tokenizer: lowercase, '
                                                                                           'asciifolding, stop, porter_stem, kstem, snowball')
 
+    parser.add_argument('--bulkprofile', default=False, action='store_true',
+                        help='No refresh, no replicas and larger translog while indexing, force merge at the end')
     args = parser.parse_args()
 
     path = args.path
@@ -76,22 +92,20 @@ if __name__ == '__main__':
             raise NameError(
                 'Invalid filter must be a subset of: lowercase, asciifolding, stop, porter_stem, kstem, snowball')
 
-    ldocs = []
-
     # Reads all the documents in a directory tree and generates an index operation for each
     lfiles = generate_files_list(path)
     print('Indexing %d files' % len(lfiles))
-    print('Reading files ...')
-    for f in lfiles:
-        ftxt = codecs.open(f, "r", encoding='iso-8859-1')
-        text = ''
-        for line in ftxt:
-            text += line
-        # Insert operation for a document with fields' path' and 'text'
-        ldocs.append({'_op_type': 'index', '_index': index, 'path': f, 'text': text})
 
     client = Elasticsearch()
 
+    manifest = None
+    if args.incremental:
+        config = {'token': args.token, 'filter': args.filter}
+        manifest = run_incremental(client, lfiles, index, args.incremental, config, args.bulkprofile, args.cache,
+                                   chunk_size=args.chunk, max_chunk_bytes=int(args.chunkmb * 2 ** 20))
+        if manifest is None:
+            sys.exit(0)
+
     # Tokenizers: whitespace classic standard letter
     my_analyzer = analyzer('default',
                            type='custom',
@@ -108,6 +122,8 @@ if __name__ == '__main__':
     # then create it
     ind.settings(number_of_shards=1)
     ind.create()
+    if args.cache:
+        TermVectorCache(client, args.cache).invalidate(index)
     ind = Index(index, using=client)
 
     # configure default analyzer
@@ -126,6 +142,20 @@ if __name__ == '__main__':
     ind.save()
     ind.open()
     print("Index settings=", ind.get_settings())
-    # Bulk execution of elastic search operations (faster than executing all one by one)
-    print('Indexing ...')
-    bulk(client, ldocs)
+    # Bulk execution of elastic search operations (faster than executing all one by one), the files are
+    # read while the operations are sent
+    print('Reading and indexing files ...')
+    time1 = time.time()
+    with bulk_load(client, index, args.bulkprofile):
+        if manifest is not None:
+            # documents with the path as _id, so they can be updated later
+            index_changes(client, lfiles, index, manifest, chunk_size=args.chunk,
+                          max_chunk_bytes=int(args.chunkmb * 2 ** 20))
+            save_manifest(args.incremental, manifest)
+        else:
+            index_files(client, lfiles, index, chunk_size=args.chunk, max_chunk_bytes=int(args.chunkmb * 2 ** 20),
+                        threads=args.threads)
+        time2 = time.time()
+        print(f'Indexing time: {time2 - time1:.2f}s')
+    if args.bulkprofile:
+        print(f'Total time with bulk load profile: {time.time() - time1:.2f}s')
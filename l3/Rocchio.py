@@ -1,9 +1,19 @@
 from elasticsearch import Elasticsearch
 from elasticsearch.exceptions import NotFoundError
+from elasticsearch.client import CatClient
 import argparse
 from elasticsearch_dsl import Search
 from elasticsearch_dsl.query import Q
-import operator
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'l2'))
+from TermVectorCache import TermVectorCache
+from TFIDFViewer import TFIDFIndex, normalize
+from TFIDFCache import TFIDFCache
 
 
 
@@ -70,17 +80,144 @@ def toTFIDF(client, index, file_id):
 
 
 
+def parse_query(query):
+    """
+    Converts a list of words with optional weights (word^weight) into a dict word -> weight
+
+    :param query:
+    :return:
+    """
+    weights = {}
+    for word in query:
+        if '^' in word:
+            term, value = word.split('^')
+            weights[term] = float(value)
+        else:
+            weights[word] = 1.0
+    return weights
+
+
+class Rocchio:
+    """
+    Rocchio relevance feedback: every round the query is searched, the TF-IDF vectors of the hits are fetched
+    with a single mtermvectors request and the new query is the R terms with largest weight in
+    ALPHA * query + BETA * centroid of the hits
+
+    The query and the document vectors are arrays over a term dictionary (term -> column) shared by all
+    the rounds, the centroid is computed with np.bincount over the columns of all the hits
+
+    With a TFIDFCache the vectors of the documents already seen (in this or other queries) are not fetched again
+    """
+
+    def __init__(self, client, index, nhits=10, alpha=0.95, beta=0.05, R=3, cache=None):
+        self.client = client
+        self.index = index
+        self.nhits = nhits
+        self.alpha = alpha
+        self.beta = beta
+        self.R = R
+        self.cache = cache
+        self.generation = None
+        self.tfidf = TFIDFIndex(client, index, chunk_size=max(nhits, 1))
+        self.terms = {}  # term -> column
+        self.vocabulary = []  # column -> term
+
+    def columns(self, terms):
+        """
+        Columns of a list of terms, new terms are added to the dictionary
+        """
+        cols = np.empty(len(terms), dtype=np.int64)
+        for i, t in enumerate(terms):
+            col = self.terms.get(t)
+            if col is None:
+                col = self.terms[t] = len(self.vocabulary)
+                self.vocabulary.append(t)
+            cols[i] = col
+        return cols
+
+    def search(self, query):
+        """
+        AND query of the words of the query (word^weight), returns the response with the first nhits hits
+        """
+        q = Q('query_string', query=query[0])
+        for word in query[1:]:
+            q &= Q('query_string', query=word)
+        return Search(using=self.client, index=self.index).query(q)[0:self.nhits].execute()
+
+    def vectors(self, ids):
+        """
+        List of the normalized TF-IDF vectors (list of pairs (term, weight)) of the documents, one mtermvectors request
+        (only for the documents that are not in the cache)
+        """
+        if self.cache is not None:
+            return [tw for _, tw in self.cache.tfidf(self.index, ids, self.generation)]
+        return [tw for _, tw in self.tfidf.tfidf(ids)]
+
+    def update(self, query, vectors):
+        """
+        New query: the R terms with largest weight in alpha * query + beta * centroid of the vectors
+
+        :param query: dict term -> weight
+        :param vectors: list of lists of pairs (term, weight)
+        :return: list of pairs (term, weight) sorted by weight
+        """
+        qcols = self.columns(list(query))
+        qweights = np.fromiter(query.values(), dtype=np.float64, count=len(query))
+        dcols = self.columns([t for tw in vectors for t, _ in tw])
+        dweights = np.fromiter((w for tw in vectors for _, w in tw), dtype=np.float64, count=len(dcols))
+
+        n = len(self.vocabulary)
+        new = self.alpha * np.bincount(qcols, qweights, minlength=n)
+        if vectors:
+            new += self.beta * np.bincount(dcols, dweights, minlength=n) / len(vectors)
+
+        # only the terms of this query and these documents, the dictionary has the terms of all the rounds
+        candidates = np.unique(np.concatenate((qcols, dcols)))
+        R = min(self.R, len(candidates))
+        best = candidates[np.argpartition(-new[candidates], R - 1)[:R]] if R > 0 else candidates[:0]
+        best = best[np.argsort(-new[best], kind='stable')]
+        return [(self.vocabulary[c], float(new[c])) for c in best]
+
+    def run(self, query, rounds=5, verbose=True):
+        """
+        Runs rounds rounds of relevance feedback from a list of words (word^weight). Prints the latency of every round
+
+        :return: the response of the last search and the query computed from it (list of word^weight)
+        """
+        if self.cache is not None:
+            self.generation = self.cache.generation(self.index)
+        for i in range(rounds):
+            time1 = time.time()
+            response = self.search(query)
+            time2 = time.time()
+            vectors = self.vectors([r.meta.id for r in response])
+            time3 = time.time()
+            new = self.update(parse_query(query), vectors)
+            time4 = time.time()
+            query = [f'{t}^{w}' for t, w in new]
+            if verbose:
+                print(f'Round {i + 1}: {len(vectors)} hits, search {time2 - time1:.3f}s, '
+                      f'term vectors {time3 - time2:.3f}s, update {time4 - time3:.4f}s, '
+                      f'total {time4 - time1:.3f}s')
+                if self.cache is not None:
+                    print(f'  cache: {self.cache.stats()}')
+                print(f'  {" ".join(query)}')
+        return response, query
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--index', default=None, help='Index to search')
     parser.add_argument('--nhits', default=10, type=int, help='Number of hits to return')
+    parser.add_argument('--cache', default=None, help='Local term vector cache file (SQLite)')
+    parser.add_argument('--queries', default=None, help='File with a query per line (- for stdin)')
+    parser.add_argument('--cachesize', default=10000, type=int, help='TF-IDF vectors kept in memory among rounds and queries')
     parser.add_argument('--query', default=None, nargs=argparse.REMAINDER, help='List of words to search')
 
     args = parser.parse_args()
 
     index = args.index
     query = args.query
-    print(query)
     nhits = args.nhits
 
     nRounds = 5
@@ -90,54 +227,23 @@ if __name__ == '__main__':
 
     try:
         client = Elasticsearch()
-        s = Search(using=client, index=index)
+        if args.cache:
+            client = TermVectorCache(client, args.cache)
 
         if query is not None:
-            for i in range(0, nRounds):
-                q = Q('query_string',query=query[0])
-                for i in range(1, len(query)):
-                    q &= Q('query_string',query=query[i])
-
-                s = s.query(q)
-                response = s[0:nhits].execute()
-
-                queries = {}
-
-                for word in query:
-                    if ('^' in word):
-                        term, value = word.split('^')
-                        queries[term] = float(value)
-                    else:
-                        queries = 1.0
-
-                docWeights = {}
-
-                for r in response:
-                    tfIdfDoc = toTFIDF(client, index, r.meta.id)
-                    for t in set(tfIdfDoc) | set(docWeights):
-                        docWeights[t] = docWeights.get(t,0) + tfIdfDoc.get(t,0)
-
-                # beta*(d_1 + d_2 + ... + dk)/k
-                for t in set(docWeights):
-                    docWeights[t] = BETA*docWeights.get(t,0)/nhits
-
-                # alpha * lastQuery
-                lastQuery = {}
-                for t in set(queries):
-                    lastQuery[t] = ALPHA*queries.get(t,0)
-
-                # newquery = docWeights + lastQuery
-                newQuery = {}
-                for t in set(lastQuery) | set(docWeights):
-                    newQuery[t] = docWeights.get(t,0) + lastQuery.get(t,0)
-
-                newQuery = sorted(newQuery.items(), key=operator.itemgetter(1), reverse=True)[:R]
-
-                query = []
-                for (term, value) in newQuery:
-                    query.append(term + '^' + str(value))
-
+            queries = [query]
+        elif args.queries is not None:
+            fqueries = sys.stdin if args.queries == '-' else open(args.queries, 'r')
+            queries = [line.split() for line in fqueries if line.strip()]
+        else:
+            queries = []
 
+        # the cache of TF-IDF vectors is shared by all the queries
+        cache = TFIDFCache(client, maxsize=args.cachesize)
+        for query in queries:
+            print(query)
+            rocchio = Rocchio(client, index, nhits=nhits, alpha=ALPHA, beta=BETA, R=R, cache=cache)
+            response, query = rocchio.run(query, nRounds)
 
             for r in response:  # only returns a specific number of results
                 print(f'ID= {r.meta.id} SCORE={r.meta.score}')
@@ -145,11 +251,12 @@ if __name__ == '__main__':
                 print(f'TEXT: {r.text[:50]}')
                 print('-----------------------------------------------------------------')
 
+            print (f"{response.hits.total['value']} Documents")
+        if queries:
+            print(f'TF-IDF cache: {cache.stats()}')
         else:
             print('No query parameters passed')
 
-        print (f"{response.hits.total['value']} Documents")
-
     except NotFoundError:
         print(f'Index {index} does not exists')
 
@@ -11,6 +11,11 @@ SearchIndex
 
     --nhits changes the number of documents to retrieve
 
+    With --batch file (- for stdin) the queries are read one per line (same word^number syntax) and sent
+    with _msearch in groups of --batchsize queries, using a single client (pool of --connections connections).
+    The results are written as JSON lines (--output, stdout by default) and the percentiles of the latency
+    are printed: time taken by the server for every query and time of every msearch request (one per batch)
+
 :Authors: bejar
     
 
@@ -24,36 +29,130 @@ from elasticsearch import Elasticsearch
 from elasticsearch.exceptions import NotFoundError
 
 import argparse
+import json
+import sys
+import time
 
-from elasticsearch_dsl import Search
+import numpy as np
+from elasticsearch_dsl import Search, MultiSearch
 from elasticsearch_dsl.query import Q
 
 __author__ = 'bejar'
 
 
+def build_query(query):
+    """
+    AND query of a list of words (word^number changes the importance of the word)
+
+    :param query:
+    :return:
+    """
+    q = Q('query_string', query=query[0])
+    for i in range(1, len(query)):
+        q &= Q('query_string', query=query[i])
+    return q
+
+
+def read_queries(fqueries):
+    """
+    Generates the list of words of every non empty line of a file
+    """
+    for line in fqueries:
+        if line.strip():
+            yield line.split()
+
+
+def batches(queries, size):
+    batch = []
+    for query in queries:
+        batch.append(query)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def run_batch(client, index, queries, nhits=10, batch_size=50, output=sys.stdout):
+    """
+    Sends the queries with _msearch in batches of batch_size and writes a JSON line with the hits of every query
+
+    :return: arrays with the time taken by the server for every query (ms) and the time of every msearch
+        request (ms)
+    """
+    took = []
+    requests = []
+    for batch in batches(queries, batch_size):
+        ms = MultiSearch(using=client, index=index)
+        for query in batch:
+            ms = ms.add(Search().query(build_query(query))[0:nhits])
+        time1 = time.time()
+        responses = ms.execute(raise_on_error=False)
+        requests.append((time.time() - time1) * 1000)
+
+        for query, response in zip(batch, responses):
+            if response is None:
+                output.write(json.dumps({'query': query, 'error': True}) + '\n')
+                continue
+            took.append(response.took)
+            output.write(json.dumps({'query': query, 'took': response.took,
+                                     'total': response.hits.total['value'],
+                                     'hits': [{'id': r.meta.id, 'score': r.meta.score, 'path': r.path}
+                                              for r in response]}) + '\n')
+    return np.array(took, dtype=np.float64), np.array(requests, dtype=np.float64)
+
+
+def print_percentiles(name, latencies, percentiles=(50, 90, 95, 99)):
+    if len(latencies) == 0:
+        print(f'{name}: no queries', file=sys.stderr)
+        return
+    values = np.percentile(latencies, percentiles)
+    print(f'{name}: ' + ', '.join(f'p{p}={v:.1f}ms' for p, v in zip(percentiles, values)) +
+          f', max={latencies.max():.1f}ms', file=sys.stderr)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--index', default=None, help='Index to search')
     parser.add_argument('--nhits', default=10, type=int, help='Number of hits to return')
+    parser.add_argument('--batch', default=None, help='File with a query per line (- for stdin)')
+    parser.add_argument('--batchsize', default=50, type=int, help='Queries per msearch request')
+    parser.add_argument('--connections', default=10, type=int, help='Connections of the client pool')
+    parser.add_argument('--output', default=None, help='JSON lines file for the results of --batch (default stdout)')
     parser.add_argument('--query', default=None, nargs=argparse.REMAINDER, help='List of words to search')
 
     args = parser.parse_args()
 
     index = args.index
     query = args.query
-    print(query)
     nhits = args.nhits
 
+    if args.batch is not None:
+        try:
+            client = Elasticsearch(maxsize=args.connections)
+            fqueries = sys.stdin if args.batch == '-' else open(args.batch, 'r')
+            output = sys.stdout if args.output is None else open(args.output, 'w')
+            time1 = time.time()
+            took, requests = run_batch(client, index, read_queries(fqueries), nhits, args.batchsize, output)
+            elapsed = time.time() - time1
+            if output is not sys.stdout:
+                output.close()
+            print(f'{len(took)} queries in {elapsed:.2f}s ({len(took) / max(elapsed, 1e-9):.1f} queries/s)',
+                  file=sys.stderr)
+            print_percentiles('Server latency', took)
+            print_percentiles(f'Request latency ({len(requests)} msearch of up to {args.batchsize} queries)', requests)
+        except NotFoundError:
+            print(f'Index {index} does not exists', file=sys.stderr)
+        sys.exit(0)
+
+    print(query)
+
     try:
         client = Elasticsearch()
         s = Search(using=client, index=index)
 
         if query is not None:
-            q = Q('query_string',query=query[0])
-            for i in range(1, len(query)):
-                q &= Q('query_string',query=query[i])
-
-            s = s.query(q)
+            s = s.query(build_query(query))
             response = s[0:nhits].execute()
             for r in response:  # only returns a specific number of results
                 print(f'ID= {r.meta.id} SCORE={r.meta.score}')
@@ -0,0 +1,154 @@
+"""
+.. module:: Convergence
+
+Convergence
+*************
+
+:Description: Convergence
+
+    Convergence criteria, per-iteration logging and extrapolation methods for the PageRank power iteration
+
+    Criteria receive the previous and the new PageRank vectors and return a residual; the iteration stops
+    when the criterion says the residual has converged:
+
+    - linf: max |Q - P| < tol
+    - l1: sum |Q - P| < tol
+    - rank: the order of the top-k airports has not changed for `patience` iterations
+
+    Extrapolation (Kamvar et al., "Extrapolation methods for accelerating PageRank computations")
+    periodically replaces the current iterate with an estimate of the limit computed from the last iterates:
+
+    - aitken: componentwise Aitken delta^2 on the last three iterates
+    - quadratic: quadratic extrapolation on the last four iterates
+
+"""
+
+import csv
+import time
+
+import numpy as np
+
+
+class LInf:
+    name = 'linf'
+
+    def __init__(self, tol):
+        self.tol = tol
+
+    def residual(self, P, Q):
+        return float(np.abs(np.asarray(Q) - np.asarray(P)).max())
+
+    def converged(self, residual):
+        return residual < self.tol
+
+
+class L1(LInf):
+    name = 'l1'
+
+    def residual(self, P, Q):
+        return float(np.abs(np.asarray(Q) - np.asarray(P)).sum())
+
+
+class RankStability:
+    name = 'rank'
+
+    def __init__(self, topk=100, patience=1):
+        self.topk = topk
+        self.patience = patience
+        self.previousTop = None
+        self.stable = 0
+
+    def residual(self, P, Q):
+        """
+        Number of positions of the top-k ranking that changed since the last iteration
+        """
+        Q = np.asarray(Q)
+        k = min(self.topk, len(Q))
+        top = np.argpartition(-Q, k - 1)[:k]
+        top = top[np.argsort(-Q[top], kind='stable')]
+        changed = k if self.previousTop is None else int((top != self.previousTop).sum())
+        self.previousTop = top
+        return changed
+
+    def converged(self, residual):
+        self.stable = self.stable + 1 if residual == 0 else 0
+        return self.stable >= self.patience
+
+
+criteria = {'linf': LInf, 'l1': L1, 'rank': RankStability}
+
+
+def makeCriterion(name, tol=1e-16, topk=100, patience=1):
+    if name == 'rank':
+        return RankStability(topk, patience)
+    return criteria[name](tol)
+
+
+class IterationLog:
+    """
+    Writes one CSV row per iteration: iteration, residual, seconds spent in the iteration,
+    elapsed seconds and the sum of the PageRank vector
+    """
+
+    def __init__(self, fd):
+        self.file = open(fd, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(['iteration', 'residual', 'seconds', 'elapsed', 'sum', 'extrapolated'])
+        self.start = self.last = time.perf_counter()
+
+    def record(self, iteration, residual, Q, extrapolated=False):
+        now = time.perf_counter()
+        self.writer.writerow([iteration, residual, now - self.last, now - self.start, float(np.sum(Q)),
+                              int(extrapolated)])
+        self.last = now
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def aitken(history):
+    """
+    Componentwise Aitken delta^2 extrapolation from the last three iterates
+    """
+    x0, x1, x2 = history[-3:]
+    d1 = x1 - x0
+    d2 = x2 - 2 * x1 + x0
+    safe = np.abs(d2) > 1e-300
+    x = x2.copy()
+    x[safe] = x0[safe] - d1[safe] ** 2 / d2[safe]
+    return x
+
+
+def quadratic(history):
+    """
+    Quadratic extrapolation from the last four iterates
+    """
+    x0, x1, x2, x3 = history[-4:]
+    Y = np.column_stack((x1 - x0, x2 - x0))
+    gamma1, gamma2 = -np.linalg.lstsq(Y, x3 - x0, rcond=None)[0]
+    gamma3 = 1.0
+    return (gamma1 + gamma2 + gamma3) * x1 + (gamma2 + gamma3) * x2 + gamma3 * x3
+
+
+extrapolations = {'aitken': (aitken, 3), 'quadratic': (quadratic, 4)}
+
+
+def extrapolate(method, history):
+    """
+    Applies the extrapolation method to the iterates in history, returns the new iterate
+    (non negative and summing 1) or None if there are not enough iterates yet
+    """
+    function, needed = extrapolations[method]
+    if len(history) < needed:
+        return None
+    x = np.maximum(function(history), 0)
+    total = x.sum()
+    if not np.isfinite(total) or total <= 0:
+        return None
+    return x / total
@@ -1,9 +1,18 @@
 #!/usr/bin/python
 
 from collections import namedtuple
+from array import array
+import argparse
+import os
 import time
 import sys
 
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from Convergence import LInf, IterationLog, makeCriterion, criteria, extrapolate, extrapolations
+from ParallelPageRank import computePageRanksParallel
+
 class Edge:
     def __init__ (self, origin=None):
         self.origin = origin
@@ -32,11 +41,22 @@ class Airport:
             newEdge = Edge(origin)
             self.routeHash[origin] = newEdge
 
+    def removeRoute (self, origin):
+        if origin not in self.routeHash:
+            return False
+        self.routeHash[origin].weight -= 1
+        if self.routeHash[origin].weight == 0:
+            del self.routeHash[origin]
+        return True
+
 
 
 airportList = [] # list of Airport
 airportHash = dict() # hash key IATA code -> Airport
 
+# Array-backed graph: airport i is codes[i], edge k is src[k] -> dst[k] with weight[k] routes
+Graph = namedtuple('Graph', ['codes', 'names', 'src', 'dst', 'weight', 'outweight'])
+
 def readAirports(fd):
     print("Reading Airport file from {0}".format(fd))
     airportsTxt = open(fd, "r", encoding="utf-8")
@@ -85,13 +105,158 @@ def readRoutes(fd):
         else:
             cont += 1
 
-def computePageRanks():
+def readAirportArrays(fd):
+    """
+    Streams the airports file into the IATA code -> int id dict and the code/name lists,
+    with the same filtering as readAirports()
+    """
+    codeIndex = dict()
+    codes = []
+    names = []
+    with open(fd, "r", encoding="utf-8") as airportsTxt:
+        for line in airportsTxt:
+            temp = line.split(',', 5)
+            if len(temp) < 5 or len(temp[4]) != 5:
+                continue
+            code = temp[4][1:-1]
+            codeIndex[code] = len(codes)
+            codes.append(code)
+            names.append(temp[1][1:-1] + ", " + temp[3][1:-1])
+    return codeIndex, codes, names
+
+def readRouteArrays(fd, codeIndex):
+    """
+    Streams the routes file into compact int arrays of (origin id, destination id), one entry per route,
+    with the same filtering as readRoutes()
+    """
+    src = array('i')
+    dst = array('i')
+    with open(fd, "r", encoding="utf-8") as routesTxt:
+        for line in routesTxt:
+            info = line.split(',', 5)
+            if len(info) < 5:
+                continue
+            origin = codeIndex.get(info[2])
+            dest = codeIndex.get(info[4])
+            if origin is None or dest is None:
+                continue
+            src.append(origin)
+            dst.append(dest)
+    return np.frombuffer(src, dtype=np.int32), np.frombuffer(dst, dtype=np.int32)
+
+def loadGraph(airportsFile, routesFile, cache=None):
+    """
+    Loads the airport graph as a Graph of numpy arrays instead of Airport/Edge objects.
+    Repeated routes are merged into a single edge whose weight is the number of routes, edges are sorted
+    by (destination, origin) and outweight[i] is the number of routes leaving airport i, as in readRoutes().
+
+    If cache is given the arrays are stored there in binary (.npz) format and reused by later runs
+    as long as the sizes and modification times of the input files do not change
+    """
+    stamp = np.array([[os.path.getsize(f), os.path.getmtime(f)] for f in (airportsFile, routesFile)])
+    if cache is not None and os.path.exists(cache):
+        with np.load(cache) as data:
+            if np.array_equal(data['stamp'], stamp):
+                print(f"Reading graph from cache {cache}")
+                return Graph(list(data['codes']), list(data['names']), data['src'], data['dst'],
+                             data['weight'], data['outweight'])
+
+    print(f"Reading Airport file from {airportsFile}")
+    codeIndex, codes, names = readAirportArrays(airportsFile)
+    print(f"There were {len(codes)} Airports with IATA code")
+    print(f"Reading Routes file from {routesFile}")
+    src, dst = readRouteArrays(routesFile, codeIndex)
+
+    n = len(codes)
+    keys, counts = np.unique(dst.astype(np.int64) * n + src, return_counts=True)
+    graph = Graph(codes, names,
+                  (keys % n).astype(np.int32), (keys // n).astype(np.int32), counts.astype(np.float64),
+                  np.bincount(src, minlength=n).astype(np.float64))
+
+    if cache is not None:
+        with open(cache, 'wb') as fd:
+            np.savez(fd, stamp=stamp, codes=np.array(codes), names=np.array(names), src=graph.src,
+                     dst=graph.dst, weight=graph.weight, outweight=graph.outweight)
+        print(f"Graph cached in {cache}")
+    return graph
+
+def applyRouteDelta(fd):
+    """
+    Applies a delta of routes to airportHash. Each line is a line of the routes file prefixed by
+    '+,' (route added) or '-,' (route removed); weights and outweight are updated as readRoutes() does
+    """
+    print(f"Reading Routes delta from {fd}")
+    added = removed = 0
+    with open(fd, "r", encoding="utf-8") as deltaTxt:
+        for line in deltaTxt:
+            op, _, route = line.partition(',')
+            info = route.split(',')
+            if op not in ('+', '-') or len(info) < 5:
+                continue
+            origin = info[2]
+            dest = info[4]
+            if origin not in airportHash or dest not in airportHash:
+                continue
+            if op == '+':
+                airportHash[dest].addRoute(origin)
+                airportHash[origin].outweight += 1
+                added += 1
+            elif airportHash[dest].removeRoute(origin):
+                airportHash[origin].outweight -= 1
+                removed += 1
+    print(f"{added} routes added, {removed} routes removed")
+
+def readPreviousPageRanks(fd):
+    """
+    Reads a previous run, either an airport_pageranks.txt file or a state file written by savePageRankState().
+    Returns the dict IATA code -> PageRank and the iterations of the cold start of that run (None if unknown)
+    """
+    if fd.endswith('.npz'):
+        with np.load(fd) as data:
+            coldIterations = int(data['coldIterations'])
+            return dict(zip(data['codes'], data['ranks'])), coldIterations if coldIterations >= 0 else None
+
+    ranks = dict()
+    with open(fd, "r", encoding="utf-8") as ranksTxt:
+        next(ranksTxt)  # header
+        for line in ranksTxt:
+            code, rank = line.split('\t')
+            ranks[code] = float(rank)
+    return ranks, None
+
+def savePageRankState(fd, codes, Q, coldIterations=None):
+    """
+    Writes the PageRanks and the iterations of a cold start of the same graph (-1 if there was no cold start)
+    """
+    with open(fd, 'wb') as stateFile:
+        np.savez(stateFile, codes=np.array(codes), ranks=np.asarray(Q, dtype=np.float64),
+                 coldIterations=coldIterations if coldIterations is not None else -1)
+    print(f"PageRank state written to {fd}")
+
+def warmStartVector(previous, codes):
+    """
+    Initial vector for an incremental run: the previous PageRank of every airport that still exists,
+    1/n for new airports, rescaled to the mass of the airports that already existed. The sum is not forced
+    to 1: the loop engine's handling of the airports without outgoing routes does not keep it, and its previous
+    vector has to be left as it is to be a fixed point again
+    """
+    n = len(codes)
+    old = np.array([code in previous for code in codes])
+    P = np.array([previous.get(code, 1/n) for code in codes], dtype=np.float64)
+    return P * (P[old].sum() / P.sum())
+
+def computePageRanks(P=None, L=0.8, tol=1e-16, maxIterations=1000, criterion=None, log=None):
     n = len(airportList) # number of vertices in G
-    P = [1/n]*n # vector of length n and sum 1 (the all 1/n vector)
-    L =  0.8 # the chosen damping factor, between 0 and 1
-    tol = 1e-16  # tolerance for the convergence, we choose 0.00000001 because the sake of science
+    warm = P is not None
+    if P is None:
+        P = [1/n]*n # vector of length n and sum 1 (the all 1/n vector)
+    else:
+        P = list(P)
+    # L is the chosen damping factor, between 0 and 1
+    # tol is the tolerance for the convergence of the default criterion (L-infinity of the difference)
+    if criterion is None:
+        criterion = LInf(tol)
     iterations = 0  # count of iterations
-    maxIterations = 1000
 
     disconnected = 0
     for airport in airportList:
@@ -99,7 +264,11 @@ def computePageRanks():
             disconnected += 1
 
     discConstWeight = disconnected*(L/float(n-1))
-    discVarWeight = 1/n
+    if warm:
+        # discVarWeight does not depend on P, a warm start begins at its fixed point (where the previous run ended)
+        discVarWeight = ((1 - L) / n) / (1 - discConstWeight)
+    else:
+        discVarWeight = 1/n
 
     while True:
         iterations += 1
@@ -119,12 +288,16 @@ def computePageRanks():
         discVarWeight = (1 - L) / n + discWeight
 
         # has converged?
-        if max(abs(Q[i] - P[i]) for i in range(n)) < tol:
+        residual = criterion.residual(P, Q)
+        if log is not None:
+            log.record(iterations, residual, Q)
+        if criterion.converged(residual):
             break
 
         P = Q
 
-        print("Sumatory of iteration", iterations, ":" , sum(i for i in P))    # Check if P sums 1 each iteration
+        if log is None:
+            print("Sumatory of iteration", iterations, ":" , sum(i for i in P))    # Check if P sums 1 each iteration
 
 
         if iterations >= maxIterations:  # if not converged and exceeded max_iterations exit
@@ -132,9 +305,114 @@ def computePageRanks():
 
     return iterations, P  # return the number of iterations and the final PageRanks values
 
-def outputPageRanks(Q):
+def routeArrays():
+    """
+    Flattens the routes of airportList into parallel arrays (origin index, destination index, weight)
+    plus the outweight of every airport, indexed by pageIndex
+    """
+    src, dst, weight = [], [], []
+    for airport in airportList:
+        for edge in airport.routeHash.values():
+            src.append(airportHash[edge.origin].pageIndex)
+            dst.append(airport.pageIndex)
+            weight.append(edge.weight)
+    outweight = np.array([airport.outweight for airport in airportList], dtype=np.float64)
+    return np.array(src, dtype=np.int64), np.array(dst, dtype=np.int64), np.array(weight, dtype=np.float64), outweight
+
+def transitionMatrix(src, dst, weight, outweight, n):
+    """
+    Builds the transition matrix M in CSR format, M[j, i] = weight(i->j) / outweight(i), so that
+    one step of the random surfer is the mat-vec product M @ P. Rows are destinations, like routeHash.
+    Also returns the boolean mask of dangling airports (outweight == 0)
+    """
+    M = csr_matrix((weight / outweight[src], (dst, src)), shape=(n, n))
+    M.sum_duplicates()
+    return M, outweight == 0
+
+def computePageRanksSparse(M, dangling, L=0.8, tol=1e-16, maxIterations=1000, P=None,
+                           criterion=None, log=None, extrapolation=None, period=10):
+    """
+    Power iteration over the CSR transition matrix. Dangling airports spread their PageRank uniformly
+    over all the airports, which is added as a rank-1 correction L * sum(P[dangling]) / n instead of
+    materializing their columns in M.
+
+    P is the initial vector (uniform if None), e.g. the previous PageRank for a warm start.
+    criterion is a Convergence criterion (L-infinity < tol if None), log an optional IterationLog and
+    extrapolation the name of a Convergence extrapolation applied every `period` iterations
+    """
+    n = M.shape[0]
+    P = np.full(n, 1/n) if P is None else np.asarray(P, dtype=np.float64)
+    if criterion is None:
+        criterion = LInf(tol)
+    history = []  # last iterates, for the extrapolation
+    iterations = 0
+
+    while True:
+        iterations += 1
+        Q = L * (M @ P)
+        Q += (1 - L) / n + L * P[dangling].sum() / n
+
+        extrapolated = False
+        if extrapolation is not None:
+            history = history[-3:] + [Q]
+            if iterations % period == 0:
+                X = extrapolate(extrapolation, history)
+                if X is not None:
+                    Q, extrapolated, history = X, True, []
+
+        # has converged?
+        residual = criterion.residual(P, Q)
+        if log is not None:
+            log.record(iterations, residual, Q, extrapolated)
+        if not extrapolated and criterion.converged(residual):
+            break
+
+        P = Q
+
+        if iterations >= maxIterations:
+            break
+
+    return iterations, Q
+
+def computePageRanksBatch(M, dangling, dampings, tol=1e-16, maxIterations=1000, P=None):
+    """
+    Computes the PageRanks for several damping factors at once. The k vectors are the columns of an
+    n x k matrix, so each iteration is a single sparse mat-mat product over M instead of k mat-vec products.
+    A column stops being updated when it converges.
+
+    Returns the iterations of every damping factor and the n x k PageRank matrix
+    """
+    n = M.shape[0]
+    L = np.asarray(dampings, dtype=np.float64)
+    k = len(L)
+    P = np.full((n, k), 1/n) if P is None else np.tile(np.asarray(P, dtype=np.float64).reshape(n, 1), (1, k))
+    danglingWeight = dangling.astype(np.float64) / n  # dangling mass of every column as one BLAS product
+    result = np.empty((n, k))
+    iterations = np.zeros(k, dtype=int)
+    active = np.arange(k)  # damping factors still iterating, P holds only their columns
+
+    while len(active) > 0:
+        iterations[active] += 1
+        La = L[active]
+        Q = (M @ P) * La
+        Q += (1 - La) / n + La * (danglingWeight @ P)
+
+        # columns that have converged or exceeded maxIterations are frozen
+        done = (np.abs(Q - P).max(axis=0) < tol) | (iterations[active] >= maxIterations)
+        P = Q
+        if done.any():
+            result[:, active[done]] = P[:, done]
+            active = active[~done]
+            P = np.ascontiguousarray(P[:, ~done])
+
+    return iterations, result
+
+def outputPageRanks(Q, codes=None, filename="airport_pageranks.txt"):
+    if codes is None:
+        codes = [airport.code for airport in airportList]
+
     # create a list of tuples (airport code, PageRank value)
-    airportRanks = [(airportList[i].code, Q[i]) for i in range(len(Q))]
+    airportRanks = [(codes[i], Q[i]) for i in range(len(Q))]
 
     # sort the list by PageRank in descending order
     airportRanks.sort(key=lambda x: x[1], reverse=True)
@@ -145,20 +423,134 @@ def outputPageRanks(Q):
         output += f"{code}\t{rank}\n"
 
     # write the output text on the file
-    with open("airport_pageranks.txt", "w") as file:
+    with open(filename, "w") as file:
         file.write(output)
 
-    print("PageRanks written to airport_pageranks.txt")
+    print(f"PageRanks written to {filename}")
 
 def main(argv=None):
-    readAirports("airports.txt")
-    readRoutes("routes.txt")
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--engine', default='loop', choices=['loop', 'sparse'],
+                        help='loop: iterate over Airport/Edge objects, sparse: CSR mat-vec power iteration')
+    parser.add_argument('--loader', default='objects', choices=['objects', 'arrays'],
+                        help='objects: Airport/Edge instances, arrays: compact numpy arrays (sparse engine only)')
+    parser.add_argument('--cache', default=None, help='Binary cache file for the arrays loader')
+    parser.add_argument('--previous', default=None,
+                        help='airport_pageranks.txt or state file (.npz) of a previous run to warm start from')
+    parser.add_argument('--delta', default=None,
+                        help='Routes added (+,route) and removed (-,route) since the previous run (objects loader only)')
+    parser.add_argument('--compare', default=False, action='store_true',
+                        help='Also run a cold start to report the iterations saved by --previous')
+    parser.add_argument('--state', default=None, help='Write the PageRanks and iteration counts to this state file (.npz)')
+    parser.add_argument('--damping', default=[0.8], type=float, nargs='+',
+                        help='Damping factor; several factors are computed in one batch (sparse engine only) '
+                             'and written to "damping <factor>.txt"')
+    parser.add_argument('--criterion', default='linf', choices=list(criteria),
+                        help='Convergence criterion: linf/l1 norm of the difference or stability of the top-k ranking')
+    parser.add_argument('--tol', default=1e-16, type=float, help='Tolerance of the linf and l1 criteria')
+    parser.add_argument('--topk', default=100, type=int, help='Airports compared by the rank criterion')
+    parser.add_argument('--patience', default=1, type=int,
+                        help='Iterations the top-k ranking must stay unchanged for the rank criterion')
+    parser.add_argument('--maxiter', default=1000, type=int, help='Maximum number of iterations')
+    parser.add_argument('--extrapolation', default=None, choices=list(extrapolations),
+                        help='Extrapolation applied periodically to accelerate convergence (sparse engine only)')
+    parser.add_argument('--period', default=10, type=int, help='Iterations between extrapolations')
+    parser.add_argument('--workers', default=1, type=int,
+                        help='Processes that share the mat-vec of the sparse engine (shared memory, one block of rows each)')
+    parser.add_argument('--log', default=None,
+                        help='CSV file with the residual and timing of every iteration (instead of printing the sums)')
+    args = parser.parse_args(argv)
+
+    batch = len(args.damping) > 1
+    if batch and args.engine == 'loop':
+        parser.error('several damping factors need the sparse engine')
+    if batch and (args.compare or args.state or args.log or args.extrapolation or args.criterion != 'linf'):
+        parser.error('--compare, --state, --log, --extrapolation and --criterion need a single damping factor')
+    if args.extrapolation and args.engine == 'loop':
+        parser.error('--extrapolation needs the sparse engine')
+    if args.workers > 1 and (args.engine == 'loop' or batch or args.extrapolation):
+        parser.error('--workers needs the sparse engine with a single damping factor and no extrapolation')
+
+    if args.loader == 'arrays' and args.engine == 'loop':
+        parser.error('the loop engine needs the objects loader')
+    if args.loader == 'arrays' and args.delta:
+        parser.error('--delta needs the objects loader')
+
+    codes = None
+    time0 = time.time()
+    if args.loader == 'arrays':
+        graph = loadGraph("airports.txt", "routes.txt", cache=args.cache)
+        codes = graph.codes
+    else:
+        readAirports("airports.txt")
+        readRoutes("routes.txt")
+        if args.delta:
+            applyRouteDelta(args.delta)
+        codes = [airport.code for airport in airportList]
+    print(f"Time of loading [{args.loader}]:", time.time()-time0)
+
+    P, coldIterations = None, None
+    if args.previous:
+        previous, coldIterations = readPreviousPageRanks(args.previous)
+        P = warmStartVector(previous, codes)
+
+    if args.engine == 'sparse':
+        if args.loader == 'arrays':
+            src, dst, weight, outweight = graph.src, graph.dst, graph.weight, graph.outweight
+        else:
+            src, dst, weight, outweight = routeArrays()
+        M, dangling = transitionMatrix(src, dst, weight, outweight, len(outweight))
+        compute = lambda P, log=None: computePageRanksSparse(
+            M, dangling, L=args.damping[0], maxIterations=args.maxiter, P=P,
+            criterion=makeCriterion(args.criterion, args.tol, args.topk, args.patience), log=log,
+            extrapolation=args.extrapolation, period=args.period)
+        if args.workers > 1:
+            compute = lambda P, log=None: computePageRanksParallel(
+                M, dangling, L=args.damping[0], maxIterations=args.maxiter, P=P, workers=args.workers,
+                criterion=makeCriterion(args.criterion, args.tol, args.topk, args.patience), log=log)
+    else:
+        compute = lambda P, log=None: computePageRanks(
+            P, L=args.damping[0], maxIterations=args.maxiter,
+            criterion=makeCriterion(args.criterion, args.tol, args.topk, args.patience), log=log)
+
+    if batch:
+        time1 = time.time()
+        iterations, Q = computePageRanksBatch(M, dangling, args.damping, tol=args.tol,
+                                              maxIterations=args.maxiter, P=P)
+        time2 = time.time()
+        for j, L in enumerate(args.damping):
+            outputPageRanks(Q[:, j], codes, filename=f"damping {L:g}.txt")
+            print(f"#Iterations (damping {L:g}):", iterations[j])
+        print("Time of computePageRanksBatch():", time2-time1)
+        return
+
     time1 = time.time()
-    iterations, Q = computePageRanks()
+    if args.log:
+        with IterationLog(args.log) as log:
+            iterations, Q = compute(P, log)
+        print(f"Iteration log written to {args.log}")
+    else:
+        iterations, Q = compute(P)
     time2 = time.time()
-    outputPageRanks(Q)
+    outputPageRanks(Q, codes)
     print("#Iterations:", iterations)
-    print("Time of computePageRanks():", time2-time1)
+    print(f"Time of computePageRanks() [{args.engine}]:", time2-time1)
+
+    # iterations of a cold start of this graph, only if one was run (the saved one is of the previous graph)
+    coldRun = None
+    if P is None:
+        coldRun = iterations
+    elif args.compare:
+        time3 = time.time()
+        coldRun, _ = compute(None)
+        coldIterations = coldRun
+        print("Time of cold start:", time.time()-time3)
+    if P is not None and coldIterations is not None:
+        print(f"Warm start: {iterations} iterations, cold start: {coldIterations} iterations "
+              f"({coldIterations - iterations} saved)")
+
+    if args.state:
+        savePageRankState(args.state, codes, Q, coldRun)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,208 @@
+#!/usr/bin/python
+"""
+.. module:: ParallelPageRank
+
+ParallelPageRank
+*************
+
+:Description: ParallelPageRank
+
+    Multi-process PageRank power iteration. The rows (destination airports) of the CSR transition matrix
+    are split in --workers blocks with the same number of edges; every process of the pool computes its
+    block of the new vector each iteration.
+
+    The CSR arrays and the two PageRank vectors live in shared memory, so the only thing sent to the
+    workers every iteration is the block number and a constant, nothing is pickled per iteration.
+
+    Run as a script it is a scaling benchmark on synthetic graphs:
+
+    python ParallelPageRank.py --nodes 1000000 --edges 10000000 --workers 1 2 4 8
+"""
+
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+import argparse
+import time
+import sys
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from Convergence import LInf
+
+
+def sharedArray(array):
+    """
+    Copies array into a new shared memory block, returns the block, the array over it and the spec to attach to it
+    """
+    shm = SharedMemory(create=True, size=max(array.nbytes, 1))
+    view = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    view[...] = array
+    return shm, view, (shm.name, array.shape, array.dtype.str)
+
+
+def attachArray(spec):
+    name, shape, dtype = spec
+    shm = SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+_worker = {}  # state of a pool process: shared arrays and the CSR blocks it has already built
+
+
+def initWorker(specs, bounds, n):
+    _worker['shm'] = []
+    for key, spec in specs.items():
+        shm, array = attachArray(spec)
+        _worker['shm'].append(shm)
+        _worker[key] = array
+    _worker['bounds'] = bounds
+    _worker['n'] = n
+    _worker['blocks'] = {}
+
+
+def workerBlock(block):
+    """
+    CSR view of the rows of a block over the shared arrays (no copy of indices and data)
+    """
+    if block not in _worker['blocks']:
+        lo, hi = _worker['bounds'][block], _worker['bounds'][block + 1]
+        indptr = _worker['indptr']
+        start, end = indptr[lo], indptr[hi]
+        _worker['blocks'][block] = (lo, hi, csr_matrix(
+            (_worker['data'][start:end], _worker['indices'][start:end], indptr[lo:hi + 1] - start),
+            shape=(hi - lo, _worker['n'])))
+    return _worker['blocks'][block]
+
+
+def workerStep(task):
+    """
+    Q[lo:hi] = L * M[lo:hi] @ P + constant, where P and Q are the shared vectors given by task
+    """
+    block, source, L, constant = task
+    lo, hi, M = workerBlock(block)
+    P = _worker['vectors'][source]
+    _worker['vectors'][1 - source][lo:hi] = L * (M @ P) + constant
+
+
+def blockBounds(indptr, blocks):
+    """
+    Splits the rows of a CSR matrix in contiguous blocks with about the same number of non zeros
+    """
+    bounds = np.searchsorted(indptr, np.linspace(0, indptr[-1], blocks + 1), side='left')
+    bounds[0], bounds[-1] = 0, len(indptr) - 1
+    return [int(b) for b in np.maximum.accumulate(bounds)]
+
+
+def computePageRanksParallel(M, dangling, L=0.8, tol=1e-16, maxIterations=1000, P=None, workers=2,
+                             criterion=None, log=None, blocksPerWorker=1, timing=None):
+    """
+    Same power iteration as PageRank.computePageRanksSparse() with the mat-vec split among `workers` processes
+
+    If timing is a dict the seconds of the setup (shared memory copy and pool start) and of the iterations
+    are stored in timing['setup'] and timing['iterations']
+    """
+    n = M.shape[0]
+    P = np.full(n, 1/n) if P is None else np.asarray(P, dtype=np.float64)
+    if criterion is None:
+        criterion = LInf(tol)
+    blocks = workers * blocksPerWorker
+    bounds = blockBounds(M.indptr, blocks)
+
+    time1 = time.time()
+    shared = []
+    specs = {}
+    view = vectors = None
+    try:
+        for key, array in (('indptr', M.indptr), ('indices', M.indices), ('data', M.data),
+                           ('vectors', np.vstack((P, np.zeros(n))))):
+            shm, view, specs[key] = sharedArray(np.ascontiguousarray(array))
+            shared.append(shm)
+        vectors = view  # rows 0 and 1 are P and Q, swapped every iteration
+        view = None
+
+        with Pool(workers, initializer=initWorker, initargs=(specs, bounds, n)) as pool:
+            time2 = time.time()
+            source = 0
+            iterations = 0
+            while True:
+                iterations += 1
+                constant = (1 - L) / n + L * vectors[source][dangling].sum() / n
+                pool.map(workerStep, [(block, source, L, constant) for block in range(blocks)])
+
+                # has converged?
+                residual = criterion.residual(vectors[source], vectors[1 - source])
+                if log is not None:
+                    log.record(iterations, residual, vectors[1 - source])
+                source = 1 - source
+                if criterion.converged(residual) or iterations >= maxIterations:
+                    break
+            Q = vectors[source].copy()
+            time3 = time.time()
+    finally:
+        view = vectors = None  # the views must be released before closing the shared memory
+        for shm in shared:
+            try:
+                shm.close()
+            except BufferError:
+                pass  # still viewed from the traceback of an error, the mapping is closed when it is released
+            shm.unlink()
+
+    if timing is not None:
+        timing['setup'] = time2 - time1
+        timing['iterations'] = time3 - time2
+
+    return iterations, Q
+
+
+def syntheticGraph(nodes, edges, seed=0):
+    """
+    Random graph with power law in-degrees, returns the transition matrix and the dangling mask
+    """
+    rng = np.random.default_rng(seed)
+    src = rng.integers(0, nodes, edges)
+    dst = (rng.pareto(1.5, edges) * nodes / 100).astype(np.int64) % nodes
+    outweight = np.bincount(src, minlength=nodes).astype(np.float64)
+    M = csr_matrix((1 / outweight[src], (dst, src)), shape=(nodes, nodes))
+    M.sum_duplicates()
+    return M, outweight == 0
+
+
+def benchmark(nodes, edges, workers, iterations, L=0.8):
+    """
+    Times `iterations` iterations of the serial mat-vec and of the process pool with every number of workers,
+    the speed-up is of the iterations only (the setup of the pool is reported apart)
+    """
+    M, dangling = syntheticGraph(nodes, edges)
+    print(f"Synthetic graph: {nodes} nodes, {M.nnz} edges")
+    fixed = LInf(-1)  # never converges, every run does the same iterations
+
+    time1 = time.time()
+    P = np.full(nodes, 1/nodes)
+    for _ in range(iterations):
+        P = L * (M @ P) + (1 - L) / nodes + L * P[dangling].sum() / nodes
+    serial = time.time() - time1
+    print(f"serial\t{serial:.3f}s\t1.00x")
+
+    for w in workers:
+        timing = {}
+        _, Q = computePageRanksParallel(M, dangling, L, maxIterations=iterations, workers=w, criterion=fixed,
+                                        timing=timing)
+        elapsed = timing['iterations']
+        print(f"{w} workers\t{elapsed:.3f}s\t{serial / elapsed:.2f}x\t(setup {timing['setup']:.3f}s, "
+              f"max diff {np.abs(Q - P).max():.2e})")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', default=1000000, type=int, help='Nodes of the synthetic graph')
+    parser.add_argument('--edges', default=10000000, type=int, help='Edges of the synthetic graph')
+    parser.add_argument('--workers', default=[1, 2, 4], type=int, nargs='+', help='Numbers of workers to compare')
+    parser.add_argument('--iterations', default=20, type=int, help='Iterations timed in every run')
+    args = parser.parse_args(argv)
+
+    benchmark(args.nodes, args.edges, args.workers, args.iterations)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
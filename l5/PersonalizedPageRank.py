@@ -0,0 +1,160 @@
+#!/usr/bin/python
+"""
+.. module:: PersonalizedPageRank
+
+PersonalizedPageRank
+*************
+
+:Description: PersonalizedPageRank
+
+    Personalized PageRank of the airports relative to a source airport (--sources MAD ...),
+    the stationary distribution of a random surfer that teleports always to the source.
+
+    The transition structure is built once from the Airport/route model of PageRank.py, queries are answered
+    with a local approximation and the last source vectors are kept in an LRU cache:
+
+    - push: forward push (Andersen, Chung, Lang), residuals smaller than --eps are not propagated
+    - montecarlo: --walks random walks from the source, each one stops with probability 1 - damping
+
+    Without --sources the airport codes are read from the standard input, one query per line
+"""
+
+from functools import lru_cache
+import argparse
+import time
+import sys
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+import PageRank
+
+
+class PersonalizedPageRank:
+    def __init__(self, codes, src, dst, weight, outweight, L=0.8, cacheSize=128):
+        """
+        Builds the out-going transition structure, row i holds the destinations of airport i
+        with probabilities weight / outweight(i)
+        """
+        n = len(codes)
+        self.codes = list(codes)
+        self.index = {code: i for i, code in enumerate(self.codes)}
+        self.L = L
+        out = csr_matrix((weight / outweight[src], (src, dst)), shape=(n, n))
+        out.sum_duplicates()
+        self.indptr, self.indices, self.probs = out.indptr, out.indices, out.data
+        self.dangling = outweight == 0
+        # the cumulative probabilities of row i are shifted by i, so one searchsorted picks
+        # the next airport of many walks that are on different airports
+        rowLength = np.diff(self.indptr)
+        cumulative = np.concatenate(([0.0], np.cumsum(self.probs)))
+        withinRow = cumulative[1:] - np.repeat(cumulative[self.indptr[:-1]], rowLength)
+        self.cumulative = np.repeat(np.arange(n), rowLength) + np.minimum(withinRow, 1.0)
+        self.vector = lru_cache(maxsize=cacheSize)(self.computeVector)
+
+    def computeVector(self, source, method='push', eps=1e-7, walks=10000, seed=None):
+        """
+        Personalized PageRank vector of the airport with index source
+        """
+        if method == 'push':
+            return self.forwardPush(source, eps)
+        return self.monteCarlo(source, walks, seed)
+
+    def forwardPush(self, source, eps):
+        """
+        Forward push: p is the estimate and r the probability mass not yet propagated. Pushing airport u
+        keeps (1 - L) * r[u] in p[u] and moves L * r[u] to its destinations (to the source if u is dangling).
+        Every round pushes at once all the airports with r[u] >= eps * outdegree(u), so only the rows of
+        the frontier are touched
+        """
+        n = len(self.codes)
+        threshold = eps * np.maximum(np.diff(self.indptr), 1)
+        p = np.zeros(n)
+        r = np.zeros(n)
+        r[source] = 1.0
+        frontier = np.array([source])
+        while len(frontier):
+            mass = r[frontier]
+            r[frontier] = 0.0
+            p[frontier] += (1 - self.L) * mass
+            r[source] += self.L * mass[self.dangling[frontier]].sum()
+
+            # positions of the frontier rows in indices/probs
+            start = self.indptr[frontier]
+            length = self.indptr[frontier + 1] - start
+            edges = np.repeat(start - np.cumsum(length) + length, length) + np.arange(length.sum())
+            targets = self.indices[edges]
+            np.add.at(r, targets, self.L * np.repeat(mass, length) * self.probs[edges])
+
+            candidates = np.append(np.unique(targets), source)
+            frontier = np.unique(candidates[r[candidates] >= threshold[candidates]])
+        return p
+
+    def monteCarlo(self, source, walks, seed=None):
+        """
+        Monte Carlo estimate: fraction of `walks` random walks from source that end on every airport.
+        The walks at a dangling airport jump back to the source
+        """
+        n = len(self.codes)
+        rng = np.random.default_rng(seed)
+        ends = np.zeros(n)
+        current = np.full(walks, source)
+        while len(current):
+            stop = rng.random(len(current)) >= self.L
+            np.add.at(ends, current[stop], 1)
+            current = current[~stop]
+            dangling = self.dangling[current]
+            current[dangling] = source
+            moving = current[~dangling]
+            step = np.searchsorted(self.cumulative, moving + rng.random(len(moving)), side='right')
+            current[~dangling] = self.indices[np.minimum(step, self.indptr[moving + 1] - 1)]
+        return ends / walks
+
+    def query(self, code, top=10, method='push', eps=1e-7, walks=10000):
+        """
+        Returns the top airports, as (code, personalized PageRank) pairs, relative to the airport code
+        """
+        if code not in self.index:
+            raise NameError(f'Airport [{code}] not found')
+        p = self.vector(self.index[code], method, eps, walks)
+        best = np.argsort(-p, kind='stable')[:top]
+        return [(self.codes[i], p[i]) for i in best]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sources', default=None, nargs='+', help='IATA codes of the source airports')
+    parser.add_argument('--method', default='push', choices=['push', 'montecarlo'], help='Approximation method')
+    parser.add_argument('--damping', default=0.8, type=float, help='Damping factor')
+    parser.add_argument('--eps', default=1e-7, type=float, help='Residual threshold of the push method')
+    parser.add_argument('--walks', default=10000, type=int, help='Random walks of the montecarlo method')
+    parser.add_argument('--top', default=10, type=int, help='Number of airports to show')
+    parser.add_argument('--cache', default=128, type=int, help='Source vectors kept in the LRU cache')
+    args = parser.parse_args(argv)
+
+    PageRank.readAirports("airports.txt")
+    PageRank.readRoutes("routes.txt")
+    time1 = time.time()
+    src, dst, weight, outweight = PageRank.routeArrays()
+    ppr = PersonalizedPageRank([airport.code for airport in PageRank.airportList], src, dst, weight, outweight,
+                               L=args.damping, cacheSize=args.cache)
+    print("Time of building the transition structure:", time.time()-time1)
+
+    sources = args.sources if args.sources else (line.strip() for line in sys.stdin)
+    for code in sources:
+        if not code:
+            continue
+        time1 = time.time()
+        try:
+            ranking = ppr.query(code.upper(), args.top, args.method, args.eps, args.walks)
+        except NameError as error:
+            print(error)
+            continue
+        print(f"Personalized PageRank relative to {code.upper()} ({(time.time()-time1)*1000:.2f} ms)")
+        for dest, rank in ranking:
+            print(f"{dest}\t{rank}")
+    print(ppr.vector.cache_info())
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,6 +8,8 @@ ExtractData
 
     Generates vector data representation with the most frequent words
 
+    With --postings file the vocabulary and the documents are read from a postings file (l2/PostingsFile.py)
+
 :Authors: bejar
     
 
@@ -22,6 +24,12 @@ from elasticsearch.helpers import scan
 from elasticsearch.exceptions import NotFoundError
 
 import argparse
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'l2'))
+from TermVectorCache import TermVectorCache
+from PostingsFile import PostingsFile
 
 __author__ = 'bejar'
 
@@ -31,6 +39,8 @@ if __name__ == '__main__':
     parser.add_argument('--minfreq', default=0.0, type=float, required=False, help='Minimum word frequency')
     parser.add_argument('--maxfreq', default=1.0, type=float, required=False, help='Maximum word frequency')
     parser.add_argument('--numwords', default=None, type=int, required=False, help='Number of words')
+    parser.add_argument('--cache', default=None, help='Local term vector cache file (SQLite)')
+    parser.add_argument('--postings', default=None, help='Postings file (PostingsFile.py) to read instead of the index')
 
     args = parser.parse_args()
 
@@ -41,22 +51,32 @@ if __name__ == '__main__':
 
     try:
         client = Elasticsearch(timeout=1000)
+        if args.cache:
+            client = TermVectorCache(client, args.cache)
         voc = {}  # global vocabulary frequency
         docterms = {}  # document vocabulary
-        print('Querying all documents ...')
-        sc = scan(client, index=index, query={"query": {"match_all": {}}})
-        print('Generating vocabulary frequencies ...')
-        for s in sc:
-            docpath = s['_source']['path']
-            docterms[docpath] = set()  # use a set for efficient operations
-            tv = client.termvectors(index=index, id=s['_id'], fields=['text'])
-            if 'text' in tv['term_vectors']:
-                for t in tv['term_vectors']['text']['terms']:
-                    docterms[docpath].add(t)
-                    if t in voc:
-                        voc[t] += 1
-                    else:
-                        voc[t] = 1
+        if args.postings:
+            # document frequencies and the terms of every document directly from the file
+            postings = PostingsFile(args.postings)
+            voc = dict(zip(postings.vocabulary, postings.df.tolist()))
+            for doc in range(postings.doc_count()):
+                tids, _ = postings.document(doc)
+                docterms[postings.path(doc)] = {postings.vocabulary[t] for t in tids.tolist()}
+        else:
+            print('Querying all documents ...')
+            sc = scan(client, index=index, query={"query": {"match_all": {}}})
+            print('Generating vocabulary frequencies ...')
+            for s in sc:
+                docpath = s['_source']['path']
+                docterms[docpath] = set()  # use a set for efficient operations
+                tv = client.termvectors(index=index, id=s['_id'], fields=['text'])
+                if 'text' in tv['term_vectors']:
+                    for t in tv['term_vectors']['text']['terms']:
+                        docterms[docpath].add(t)
+                        if t in voc:
+                            voc[t] += 1
+                        else:
+                            voc[t] = 1
         lwords = []
 
         # Compute overall words relative frequency
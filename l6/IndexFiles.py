@@ -11,6 +11,12 @@ IndexFiles
 
     If the index exists it is dropped and created new
 
+    With --workers N the files are read by N threads and sent by --senders threads in bulk requests of
+    --chunk documents, at most --queue documents read wait in memory to be sent (readers block when it is full)
+
+    With --incremental manifest.json only the files added, changed or removed since the last run are
+    sent to the index (see l2/IncrementalIndex.py)
+
     Documentation for the analyzer configuration:
 
     https://www.elastic.co/guide/en/elasticsearch/reference/current/analysis.html
@@ -26,9 +32,17 @@ IndexFiles
 from elasticsearch import Elasticsearch
 from elasticsearch.helpers import bulk
 from elasticsearch.exceptions import NotFoundError
+from queue import Queue, Full
 import argparse
 import os
 import codecs
+import threading
+import time
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'l2'))
+from BulkLoad import bulk_load
+from IncrementalIndex import save_manifest, index_changes, run_incremental
 from elasticsearch_dsl import Index, analyzer, tokenizer
 
 def generate_files_list(path):
@@ -49,12 +63,106 @@ def generate_files_list(path):
     return lfiles
 
 
+def index_files_parallel(client, lfiles, index, workers=4, senders=2, chunk_size=500, max_queued=2000):
+    """
+    Reads the files with workers threads and sends them with senders threads in bulk requests of chunk_size
+    documents. The documents read wait in a queue of max_queued documents, so at most
+    max_queued + senders * chunk_size documents are in memory
+
+    If a bulk request raises (e.g. ConnectionError) or a file can not be read the readers stop, the documents
+    left in the queue are discarded and the first exception is raised again when all the threads have finished
+    :return: number of documents indexed and number of errors
+    """
+    queue = Queue(maxsize=max_queued)
+    files = iter(lfiles)
+    files_lock = threading.Lock()
+    counts = {'docs': 0, 'errors': 0}
+    counts_lock = threading.Lock()
+    stop = threading.Event()
+    failures = []
+
+    def fail(exc):
+        with counts_lock:
+            failures.append(exc)
+        stop.set()
+
+    def reader():
+        try:
+            while not stop.is_set():
+                with files_lock:
+                    f = next(files, None)
+                if f is None:
+                    return
+                with codecs.open(f, "r", encoding='iso-8859-1') as ftxt:
+                    text = ftxt.read()
+                # Insert operation for a document with fields' path' and 'text', waits while the queue is full
+                doc = {'_op_type': 'index', '_index': index, 'path': f, 'text': text}
+                while not stop.is_set():
+                    try:
+                        queue.put(doc, timeout=0.5)
+                        break
+                    except Full:
+                        pass
+        except Exception as exc:
+            fail(exc)
+
+    def send(chunk):
+        if stop.is_set():
+            return
+        try:
+            ok, errors = bulk(client, chunk, raise_on_error=False, stats_only=True)
+        except Exception as exc:
+            ok, errors = 0, len(chunk)
+            fail(exc)
+        with counts_lock:
+            counts['docs'] += ok
+            counts['errors'] += errors
+
+    def sender():
+        # keeps taking documents after a failure, so the readers and the end marks never block
+        chunk = []
+        while True:
+            doc = queue.get()
+            if doc is None:
+                break
+            chunk.append(doc)
+            if len(chunk) == chunk_size:
+                send(chunk)
+                chunk = []
+        if chunk:
+            send(chunk)
+
+    start = time.time()
+    reader_threads = [threading.Thread(target=reader) for _ in range(workers)]
+    sender_threads = [threading.Thread(target=sender) for _ in range(senders)]
+    for t in reader_threads + sender_threads:
+        t.start()
+    for t in reader_threads:
+        t.join()
+    for _ in sender_threads:
+        queue.put(None)  # one end mark for every sender
+    for t in sender_threads:
+        t.join()
+    elapsed = max(time.time() - start, 1e-9)
+    print(f'{counts["docs"]} documents indexed, {counts["errors"]} errors, {counts["docs"] / elapsed:.1f} docs/s')
+    if failures:
+        raise failures[0]
+    return counts['docs'], counts['errors']
+
+
 __author__ = 'bejar'
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--path', required=True, default=None, help='Path to the files')
     parser.add_argument('--index', required=True, default=None, help='Index for the files')
+    parser.add_argument('--workers', default=None, type=int, help='Threads reading the files (parallel indexing)')
+    parser.add_argument('--senders', default=2, type=int, help='Threads sending bulk requests with --workers')
+    parser.add_argument('--chunk', default=500, type=int, help='Documents per bulk request with --workers')
+    parser.add_argument('--queue', default=2000, type=int, help='Maximum documents waiting to be sent with --workers')
+    parser.add_argument('--incremental', default=None, help='Manifest file, index only the files that changed')
+    parser.add_argument('--bulkprofile', default=False, action='store_true',
+                        help='No refresh, no replicas and larger translog while indexing, force merge at the end')
     args = parser.parse_args()
 
     path = args.path
@@ -65,17 +173,26 @@ if __name__ == '__main__':
     # Reads all the documents in a directory tree and generates an index operation for each
     lfiles = generate_files_list(path)
     print(f'Indexing {len(lfiles)} files')
-    print('Reading files ...')
-    for f in lfiles:
-        ftxt = codecs.open(f, "r", encoding='iso-8859-1')
-        text = ''
-        for line in ftxt:
-            text += line
-        # Insert operation for a document with fields' path' and 'text'
-        ldocs.append({'_op_type': 'index', '_index': index, 'path': f, 'text': text})
+    if not args.workers and not args.incremental:
+        print('Reading files ...')
+        for f in lfiles:
+            ftxt = codecs.open(f, "r", encoding='iso-8859-1')
+            text = ''
+            for line in ftxt:
+                text += line
+            # Insert operation for a document with fields' path' and 'text'
+            ldocs.append({'_op_type': 'index', '_index': index, 'path': f, 'text': text})
 
     client = Elasticsearch(timeout=1000)
 
+    manifest = None
+    if args.incremental:
+        manifest = run_incremental(client, lfiles, index, args.incremental,
+                                   {'analyzer': 'letter lowercase stop asciifolding snowball length 2-10'},
+                                   args.bulkprofile, chunk_size=args.chunk)
+        if manifest is None:
+            sys.exit(0)
+
     try:
         # Drop index if it exists
         ind = Index(index, using=client)
@@ -127,5 +244,19 @@ if __name__ == '__main__':
     print("Index settings=", ind.get_settings())
     # Bulk execution of elastic search operations (faster than executing all one by one)
     print('Indexing ...')
-    bulk(client, ldocs)
+    time1 = time.time()
+    with bulk_load(client, index, args.bulkprofile):
+        if manifest is not None:
+            # documents with the path as _id, so they can be updated later
+            index_changes(client, lfiles, index, manifest, chunk_size=args.chunk)
+            save_manifest(args.incremental, manifest)
+        elif args.workers:
+            index_files_parallel(client, lfiles, index, workers=args.workers, senders=args.senders,
+                                 chunk_size=args.chunk, max_queued=args.queue)
+        else:
+            bulk(client, ldocs)
+        time2 = time.time()
+        print(f'Indexing time: {time2 - time1:.2f}s')
+    if args.bulkprofile:
+        print(f'Total time with bulk load profile: {time.time() - time1:.2f}s')
 